@@ -0,0 +1,170 @@
+"""
+Runs the benchmarks.
+
+Usage: python -m benchmarks [-n 2000] [--latency 0.2] [--save baseline.json] [--compare baseline.json]
+
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import sys
+import time
+
+from benchmarks.fakes import FakeClient, FakePool, FakeRedis
+from benchmarks.workloads import WORKLOADS, Environment
+from navalbot.api import batching, db, factoids, permissions, pipeline, util, writes
+
+
+def _percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def _reset(redis: FakeRedis):
+    """
+    Points every cache and pool at a fresh fake redis.
+    """
+    util.redis_pool = FakePool(redis)
+    db.invalidate_all()
+    batching._batcher = None
+    permissions._resolver = None
+    factoids._filter = None
+    writes._buffer = None
+    pipeline._index = None
+
+
+async def run_workload(loop, workload, count: int, warmup: int, latency: float, concurrency: int) -> dict:
+    redis = FakeRedis(loop, latency=latency)
+    _reset(redis)
+    client = FakeClient(loop)
+    env = Environment()
+    workload.setup(env, redis, client)
+    # The bot builds this once at startup.
+    await factoids.get_filter().build()
+
+    async def handle(message):
+        start = time.perf_counter()
+        await client.on_message(message)
+        return time.perf_counter() - start
+
+    for i in range(warmup):
+        await handle(workload.make(env, i))
+
+    redis.round_trips = 0
+    timings = []
+    start = time.perf_counter()
+    for i in range(0, count, concurrency):
+        batch = [workload.make(env, warmup + j) for j in range(i, min(count, i + concurrency))]
+        timings.extend(await asyncio.gather(*[handle(m) for m in batch]))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "messages": count,
+        "messages_per_second": count / elapsed,
+        "p50_ms": _percentile(timings, 50) * 1000,
+        "p99_ms": _percentile(timings, 99) * 1000,
+        "redis_round_trips_per_message": redis.round_trips / count,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares results to a baseline. Returns a list of regressions.
+    """
+    regressions = []
+    for name, result in results["workloads"].items():
+        old = baseline.get("workloads", {}).get(name)
+        if old is None:
+            continue
+        checks = [
+            ("messages_per_second",
+             result["messages_per_second"] < old["messages_per_second"] * (1 - threshold)),
+            ("p99_ms",
+             result["p99_ms"] > old["p99_ms"] * (1 + threshold)),
+            ("redis_round_trips_per_message",
+             result["redis_round_trips_per_message"] > old["redis_round_trips_per_message"] + 1e-9),
+        ]
+        for metric, regressed in checks:
+            print("  {:<14} {:<30} {:>12.3f} -> {:>12.3f}{}".format(
+                name, metric, old[metric], result[metric], "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the NavalBot message handling hot path.")
+    parser.add_argument("-n", "--messages", type=int, default=2000, help="Messages per workload.")
+    parser.add_argument("--warmup", type=int, default=200, help="Messages sent before measuring.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated redis latency, in milliseconds.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Messages handled at once.")
+    parser.add_argument("--only", nargs="*", help="Only run these workloads.")
+    parser.add_argument("--save", help="Save the results as JSON to this file.")
+    parser.add_argument("--compare", help="Compare the results against this JSON baseline.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed slowdown when comparing (0.1 = 10%%).")
+    args = parser.parse_args()
+
+    # Per-message logging would dominate the timings.
+    logging.disable(logging.WARNING)
+
+    loop = util.loop
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "messages": args.messages,
+            "latency_ms": args.latency,
+            "concurrency": args.concurrency,
+        },
+        "workloads": {},
+    }
+
+    for cls in WORKLOADS:
+        if args.only and cls.name not in args.only:
+            continue
+        result = loop.run_until_complete(run_workload(loop, cls(), args.messages, args.warmup, args.latency / 1000,
+                                                      args.concurrency))
+        results["workloads"][cls.name] = result
+        print("{:<14} {:>10.0f} msg/s  p50 {:>7.3f}ms  p99 {:>7.3f}ms  {:>5.2f} redis round trips/msg".format(
+            cls.name, result["messages_per_second"], result["p50_ms"], result["p99_ms"],
+            result["redis_round_trips_per_message"]))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved results to {}".format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("Compared to {}:".format(args.compare))
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
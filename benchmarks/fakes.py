@@ -0,0 +1,291 @@
+"""
+Fake discord objects, client and redis used by the benchmarks.
+
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+import asyncio
+import datetime
+import fnmatch
+import itertools
+
+import discord
+
+from navalbot.api.blacklist import Blacklist
+from navalbot.api.botcls import NavalClient
+from navalbot.api.deletions import DeleteBatcher
+from navalbot.api.dispatch import HookDispatcher
+from navalbot.api.pipeline import MessagePipeline
+from navalbot.api.scheduler import CommandScheduler
+
+_ids = itertools.count(100000)
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+# region redis
+class FakeRedis(object):
+    """
+    An in-memory stand-in for an aioredis connection.
+
+    Every awaited command, and every executed pipeline, counts as one round trip. Commands are answered after
+    `latency` seconds, to model the network.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, latency: float = 0.0):
+        self.loop = loop
+        self.latency = latency
+        self.data = {}
+        self.round_trips = 0
+
+    def _reply(self, value, count: bool = True):
+        # Commands which aren't counted are part of a pipeline, which pays the latency once on execute().
+        fut = self.loop.create_future()
+        if count:
+            self.round_trips += 1
+        if count and self.latency:
+            self.loop.call_later(self.latency, fut.set_result, value)
+        else:
+            fut.set_result(value)
+        return fut
+
+    # region commands
+    def _get(self, key):
+        value = self.data.get(_encode(key))
+        return value if isinstance(value, bytes) else None
+
+    def get(self, key, _count=True):
+        return self._reply(self._get(key), _count)
+
+    def mget(self, key, *keys, _count=True):
+        return self._reply([self._get(k) for k in (key,) + keys], _count)
+
+    def exists(self, key, _count=True):
+        return self._reply(int(_encode(key) in self.data), _count)
+
+    def set(self, key, value, _count=True):
+        self.data[_encode(key)] = _encode(value)
+        return self._reply(True, _count)
+
+    def delete(self, key, *keys, _count=True):
+        removed = sum(1 for k in (key,) + keys if self.data.pop(_encode(k), None) is not None)
+        return self._reply(removed, _count)
+
+    def hset(self, key, field, value, _count=True):
+        self.data.setdefault(_encode(key), {})[_encode(field)] = _encode(value)
+        return self._reply(1, _count)
+
+    def hsetnx(self, key, field, value, _count=True):
+        h = self.data.setdefault(_encode(key), {})
+        h.setdefault(_encode(field), _encode(value))
+        return self._reply(1, _count)
+
+    def hdel(self, key, field, *fields, _count=True):
+        h = self.data.get(_encode(key), {})
+        removed = sum(1 for f in (field,) + fields if h.pop(_encode(f), None) is not None)
+        return self._reply(removed, _count)
+
+    def hget(self, key, field, _count=True):
+        return self._reply(self.data.get(_encode(key), {}).get(_encode(field)), _count)
+
+    def hmget(self, key, field, *fields, _count=True):
+        h = self.data.get(_encode(key), {})
+        return self._reply([h.get(_encode(f)) for f in (field,) + fields], _count)
+
+    def hgetall(self, key, _count=True):
+        return self._reply(dict(self.data.get(_encode(key), {})), _count)
+
+    def hkeys(self, key, _count=True):
+        return self._reply(list(self.data.get(_encode(key), {}).keys()), _count)
+
+    def smembers(self, key, _count=True):
+        return self._reply(set(self.data.get(_encode(key), set())), _count)
+
+    def sadd(self, key, member, *members, _count=True):
+        s = self.data.setdefault(_encode(key), set())
+        s.update(_encode(m) for m in (member,) + members)
+        return self._reply(1, _count)
+
+    def srem(self, key, member, *members, _count=True):
+        s = self.data.get(_encode(key), set())
+        s.difference_update(_encode(m) for m in (member,) + members)
+        return self._reply(1, _count)
+
+    def publish(self, channel, message, _count=True):
+        return self._reply(0, _count)
+
+    def scan(self, cursor=0, match=None, count=None, _count=True):
+        keys = [k for k in self.data if match is None or fnmatch.fnmatchcase(k.decode(), match)]
+        return self._reply((0, keys), _count)
+
+    # endregion
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    multi_exec = pipeline
+
+
+class FakePipeline(object):
+    """
+    Buffers commands, and runs them in one round trip.
+    """
+
+    def __init__(self, redis: FakeRedis):
+        self._redis = redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name)
+
+        def buffered(*args, **kwargs):
+            fut = self._redis.loop.create_future()
+            self._calls.append((fut, func, args, kwargs))
+            return fut
+
+        return buffered
+
+    async def execute(self, *, return_exceptions=False):
+        results = []
+        for fut, func, args, kwargs in self._calls:
+            result = await func(*args, _count=False, **kwargs)
+            fut.set_result(result)
+            results.append(result)
+        await self._redis._reply(None)
+        return results
+
+
+class _PoolContext(object):
+    def __init__(self, redis: FakeRedis):
+        self._redis = redis
+
+    async def __aenter__(self):
+        return self._redis
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakePool(object):
+    """
+    Stands in for the aioredis pool, handing out the same FakeRedis every time.
+    """
+
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+
+    def get(self):
+        return _PoolContext(self.redis)
+
+
+# endregion
+
+# region discord
+class FakeRole(discord.Role):
+    def __init__(self, name: str, server=None):
+        self.id = str(next(_ids))
+        self.name = name
+        self.server = server
+
+
+class FakeServer(discord.Server):
+    def __init__(self, name: str = "Benchmark Server"):
+        self.id = str(next(_ids))
+        self.name = name
+        self.owner = None
+        self.roles = []
+
+
+class FakeChannel(discord.Channel):
+    def __init__(self, server: FakeServer, name: str = "general"):
+        self.id = str(next(_ids))
+        self.name = name
+        self.server = server
+        self.is_private = False
+
+
+class FakeMember(discord.Member):
+    def __init__(self, server: FakeServer, name: str, roles=(), bot: bool = False):
+        self.id = str(next(_ids))
+        self.name = name
+        self.bot = bot
+        self.server = server
+        self.roles = [FakeRole(r, server) for r in roles]
+
+
+class FakeMessage(discord.Message):
+    def __init__(self, channel: FakeChannel, author: FakeMember, content: str):
+        self.id = str(next(_ids))
+        self.channel = channel
+        self.server = channel.server
+        self.author = author
+        self.content = content
+        self.attachments = []
+        self.timestamp = datetime.datetime.utcnow()
+
+
+class FakeClient(NavalClient):
+    """
+    A NavalClient which never connects, and records what it would have sent.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        # Skip the singleton, and the logging setup that comes with it.
+        return object.__new__(cls)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        # Deliberately don't call discord.Client.__init__, which would set up HTTP and the gateway.
+        self.loop = loop
+        self.config = {}
+        self.modules = {}
+        self.hooks = {}
+        self.dispatcher = HookDispatcher(loop, self.hooks)
+        self.blacklist = Blacklist()
+        self.deleter = DeleteBatcher(self)
+        self.scheduler = CommandScheduler(loop)
+        self.pipeline = MessagePipeline()
+        self.add_default_stages()
+        self._raven_client = None
+        self.user = discord.User(username="NavalBot", id="1", discriminator="0000", avatar=None, bot=True)
+
+        self.sent = 0
+        self.deleted = 0
+
+    def __del__(self):
+        pass
+
+    async def send_message(self, destination, content=None, *args, **kwargs):
+        self.sent += 1
+
+    async def send_file(self, destination, fp, *args, **kwargs):
+        self.sent += 1
+
+    async def delete_message(self, message):
+        self.deleted += 1
+
+    async def delete_messages(self, messages):
+        self.deleted += len(messages)
+
+# endregion
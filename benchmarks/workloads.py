@@ -0,0 +1,149 @@
+"""
+Synthetic message workloads.
+
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+import discord
+
+from benchmarks.fakes import FakeChannel, FakeMember, FakeMessage, FakeServer
+from navalbot.api.commands import command
+
+
+# region commands
+@command("bench_typed", argcount=2)
+async def bench_typed(client: discord.Client, message: discord.Message, count: int, word: str):
+    """
+    A command with typed arguments.
+    """
+    return "{} {}".format(word, count)
+
+
+@command("bench_roles", roles={"Admin"})
+async def bench_roles(client: discord.Client, message: discord.Message):
+    """
+    A role gated command.
+    """
+    return "ok"
+
+
+# endregion
+
+
+class Environment(object):
+    """
+    The server, channel and members messages are sent from.
+    """
+
+    def __init__(self):
+        self.server = FakeServer()
+        self.channel = FakeChannel(self.server)
+        self.member = FakeMember(self.server, "member")
+        self.admin = FakeMember(self.server, "admin", roles=("Admin",))
+        self.blacklisted = FakeMember(self.server, "blacklisted")
+
+    def message(self, content: str, author: FakeMember = None) -> FakeMessage:
+        return FakeMessage(self.channel, author or self.member, content)
+
+
+class Workload(object):
+    """
+    A named stream of messages.
+    """
+    name = None
+    description = None
+
+    def setup(self, env: Environment, redis, client):
+        """
+        Seeds redis, and the client, before the workload runs.
+        """
+
+    def make(self, env: Environment, i: int) -> FakeMessage:
+        raise NotImplementedError
+
+
+class Chatter(Workload):
+    name = "chatter"
+    description = "Plain chat which isn't a command."
+
+    def make(self, env, i):
+        return env.message("just talking about things number {}".format(i))
+
+
+class TypedCommand(Workload):
+    name = "typed_command"
+    description = "A command with argcount and int/str annotations."
+
+    def make(self, env, i):
+        return env.message("?bench_typed {} word".format(i))
+
+
+class RoleGatedCommand(Workload):
+    name = "role_gated"
+    description = "A command restricted to a role, ran by a member with it."
+
+    def make(self, env, i):
+        return env.message("?bench_roles", author=env.admin)
+
+
+class FactoidHit(Workload):
+    name = "factoid_hit"
+    description = "An existing factoid."
+
+    def setup(self, env, redis, client):
+        redis.data["config:{}:fac:bench".format(env.server.id).encode()] = b"a benchmark factoid"
+
+    def make(self, env, i):
+        return env.message("?bench")
+
+
+class FactoidMiss(Workload):
+    name = "factoid_miss"
+    description = "Prefixed words which are neither commands nor factoids."
+
+    def make(self, env, i):
+        # Cycle through a few names, like typos and other bots' commands would.
+        return env.message("?nosuch{}".format(i % 50))
+
+
+class Blacklisted(Workload):
+    name = "blacklisted"
+    description = "Commands from a blacklisted user."
+
+    def setup(self, env, redis, client):
+        client.blacklist.index = {env.server.id: frozenset([env.blacklisted.id])}
+
+    def make(self, env, i):
+        return env.message("?bench_typed 1 word", author=env.blacklisted)
+
+
+class Autodelete(Workload):
+    name = "autodelete"
+    description = "Commands in a server with autodelete enabled."
+
+    def setup(self, env, redis, client):
+        redis.data["config:{}:autodelete".format(env.server.id).encode()] = b"True"
+
+    def make(self, env, i):
+        return env.message("?bench_typed {} word".format(i))
+
+
+WORKLOADS = [Chatter, TypedCommand, RoleGatedCommand, FactoidHit, FactoidMiss, Blacklisted, Autodelete]
@@ -26,85 +26,126 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 =================================
 """
 
+import argparse
 import asyncio
 
 import os
 import sys
 from ctypes.util import find_library
 
-import discord
-import requests
+# Imported first, so the timings cover everything else.
+from navalbot.api import startup
 
-# Load config.
-import shutil
-import yaml
+with startup.phase("import discord"):
+    import discord
 
-from navalbot.api import botcls
+with startup.phase("import navalbot"):
+    from navalbot.api import botcls, settings
 
-if not os.path.exists("config.yml"):
-    shutil.copyfile("config.example.yml", "config.yml")
 
-with open("config.yml", "r") as f:
-    global_config = yaml.load(f)
+def load_config() -> dict:
+    return settings.load()
 
-if global_config.get("use_libuv", False):
-    print("WARNING: Using libuv faster event loop for NavalBot.")
-    print("Voice modules will not work properly.")
-    import uvloop
 
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+def setup_event_loop(global_config: dict):
+    if global_config.get("use_libuv", False):
+        print("WARNING: Using libuv faster event loop for NavalBot.")
+        print("Voice modules will not work properly.")
+        import uvloop
 
-# Load opus
-if sys.platform == "win32":
-    if os.path.exists(os.path.join(os.getcwd(), "libopus.dll")):
-        found = "libopus"
-    else:
-        found = False
-    has_setproctitle = False
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-else:
-    found = find_library("opus")
-    has_setproctitle = True
-    import setproctitle
-if found:
-    print(">> Loaded libopus from {}".format(found))
-    discord.opus.load_opus(found)
-else:
+
+def load_opus():
+    # Load opus
     if sys.platform == "win32":
-        print(">> Downloading libopus for Windows.")
-        sfbit = sys.maxsize > 2 ** 32
-        if sfbit:
-            to_dl = 'x64'
+        if os.path.exists(os.path.join(os.getcwd(), "libopus.dll")):
+            found = "libopus"
         else:
-            to_dl = 'x86'
-        r = requests.get("https://github.com/SexualRhinoceros/MusicBot/raw/develop/libopus-0.{}.dll".format(to_dl),
-                         stream=True)
-        # Save it as libopus.dll
-        with open("libopus.dll", 'wb') as f:
-            for chunk in r.iter_content(256):
-                f.write(chunk)
-        discord.opus.load_opus("libopus")
-        del sfbit, to_dl
+            found = False
     else:
-        print(">> Cannot load opus library - cannot use voice.")
-        del found
-
-# Create a client.
-# Also, use shards as appropriate.
-if global_config.get("shards", {}).get("enable_sharding"):
-    # Todo -> Auto shards
-    shards = global_config["shards"]["shard_max"]
-    my_shard = global_config["shards"]["shard_id"]
-    client = botcls.NavalClient(shard_count=int(shards), shard_id=int(my_shard))
-else:
-    client = botcls.NavalClient()
-
-# Update process title.
-if has_setproctitle:
-    setproctitle.setproctitle("NavalBot - {bot_id}".format(
-        bot_id=global_config.get("client", {}).get("oauth_client_id", "???"))
-    )
-
-# Invoke bot.run().
-if __name__ == '__main__':
+        found = find_library("opus")
+    if found:
+        print(">> Loaded libopus from {}".format(found))
+        discord.opus.load_opus(found)
+    else:
+        if sys.platform == "win32":
+            print(">> Downloading libopus for Windows.")
+            import requests
+            sfbit = sys.maxsize > 2 ** 32
+            if sfbit:
+                to_dl = 'x64'
+            else:
+                to_dl = 'x86'
+            r = requests.get("https://github.com/SexualRhinoceros/MusicBot/raw/develop/libopus-0.{}.dll".format(to_dl),
+                             stream=True)
+            # Save it as libopus.dll
+            with open("libopus.dll", 'wb') as f:
+                for chunk in r.iter_content(256):
+                    f.write(chunk)
+            discord.opus.load_opus("libopus")
+        else:
+            print(">> Cannot load opus library - cannot use voice.")
+
+
+def create_client(global_config: dict, shard_id: int = None, shard_count: int = None) -> botcls.NavalClient:
+    # Create a client.
+    # Also, use shards as appropriate.
+    if shard_count is not None:
+        # Given by the supervisor.
+        client = botcls.NavalClient(shard_count=shard_count, shard_id=shard_id)
+        # Every shard on this host needs its own metrics port.
+        metrics_cfg = client.config.get("metrics") or {}
+        if metrics_cfg.get("enabled"):
+            metrics_cfg["port"] = int(metrics_cfg.get("port", 9091)) + shard_id
+            client.config["metrics"] = metrics_cfg
+    elif global_config.get("shards", {}).get("enable_sharding"):
+        shards = global_config["shards"]["shard_max"]
+        my_shard = global_config["shards"]["shard_id"]
+        client = botcls.NavalClient(shard_count=int(shards), shard_id=int(my_shard))
+    else:
+        client = botcls.NavalClient()
+    return client
+
+
+def set_title(global_config: dict, shard_id: int = None):
+    # Update process title.
+    if sys.platform == "win32":
+        return
+    import setproctitle
+    title = "NavalBot - {bot_id}".format(bot_id=global_config.get("client", {}).get("oauth_client_id", "???"))
+    if shard_id is not None:
+        title += " - shard {}".format(shard_id)
+    setproctitle.setproctitle(title)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs NavalBot. Use `python -m navalbot.supervisor` to run every "
+                                                 "shard automatically.")
+    parser.add_argument("--shard-id", type=int, help="The shard to run. Overrides config.yml.")
+    parser.add_argument("--shard-count", type=int, help="The total number of shards. Overrides config.yml.")
+    args = parser.parse_args()
+    if (args.shard_id is None) != (args.shard_count is None):
+        parser.error("--shard-id and --shard-count must be given together.")
+
+    with startup.phase("config"):
+        global_config = load_config()
+        setup_event_loop(global_config)
+    with startup.phase("opus"):
+        load_opus()
+    with startup.phase("client"):
+        client = create_client(global_config, args.shard_id, args.shard_count)
+        set_title(global_config, args.shard_id)
+
+    # Report to the supervisor, if there is one.
+    heartbeat = os.environ.get("NAVALBOT_HEARTBEAT")
+    if heartbeat:
+        from navalbot import supervisor
+        supervisor.start_heartbeat(client, heartbeat, args.shard_id)
+
+    # Invoke bot.run().
     client.navalbot()
+
+
+if __name__ == '__main__':
+    main()
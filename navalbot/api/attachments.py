@@ -0,0 +1,195 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Attachment serving.
+# Disk access never happens on the event loop. Small, hot files are kept in memory ready to send, and larger ones
+# are memory mapped and faulted in by a worker thread, so the upload only ever copies from memory.
+import asyncio
+import collections
+import io
+import logging
+import mmap
+import os
+
+import discord
+
+from navalbot.api import metrics, util
+from navalbot.api.cache import MISSING
+
+logger = logging.getLogger("NavalBot")
+
+_server = None
+
+PAGE_SIZE = mmap.PAGESIZE
+
+
+def _read(path: str, max_cached: int, known: tuple = None):
+    """
+    Reads a file, in a worker thread.
+
+    Returns (key, bytes) for small files, (key, mmap) for large ones, or None if the file doesn't exist.
+    The key changes whenever the file is replaced. If it matches `known`, nothing is read, and (key, None) is returned.
+    """
+    try:
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            key = (path, st.st_mtime_ns, st.st_size)
+            if key == known:
+                return key, None
+            if st.st_size <= max_cached:
+                return key, f.read()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    # Touch every page now, so the upload doesn't fault on the loop.
+    for offset in range(0, len(mapped), PAGE_SIZE):
+        mapped[offset]
+    return key, mapped
+
+
+class AttachmentServer(object):
+    """
+    Sends files from disk without blocking the event loop.
+    """
+
+    def __init__(self):
+        cfg = util.get_global_config("files", default={}) or {}
+        self.cache_size = int(float(cfg.get("cache_mb", 32)) * 1024 * 1024)
+        self.max_cached = int(float(cfg.get("cache_max_file_kb", 512)) * 1024)
+
+        # path -> (key, bytes), least recently used first. Bounded by cache_size in bytes, which _cache_put keeps to.
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        # (path, known key) -> future, so a burst of requests for one file only reads it once.
+        self._pending = {}
+
+    def _cache_put(self, path: str, key: tuple, data: bytes):
+        self.invalidate(path)
+        self._cache[path] = (key, data)
+        self._cached_bytes += len(data)
+        while self._cached_bytes > self.cache_size:
+            self._cached_bytes -= len(self._cache.popitem(last=False)[1][1])
+
+    def _cache_get(self, path: str):
+        cached = self._cache.get(path, MISSING)
+        if cached is not MISSING:
+            self._cache.move_to_end(path)
+        return cached
+
+    def invalidate(self, path: str):
+        old = self._cache.pop(path, None)
+        if old is not None:
+            self._cached_bytes -= len(old[1])
+
+    async def _load(self, path: str, known: tuple = None):
+        pending_key = (path, known)
+        fut = self._pending.get(pending_key)
+        if fut is None:
+            fut = self._pending[pending_key] = asyncio.ensure_future(
+                util.with_threading(lambda: _read(path, self.max_cached, known)))
+            fut.add_done_callback(lambda f: self._pending.pop(pending_key, None))
+        return await asyncio.shield(fut)
+
+    async def send(self, client: discord.Client, destination, path: str, filename: str = None,
+                   immutable: bool = False) -> bool:
+        """
+        Sends a file.
+
+        Pass immutable=True for files which are never replaced, such as content-addressed ones, to serve them from
+        memory without checking the disk at all.
+        Returns False if the file doesn't exist.
+        """
+        filename = filename or os.path.basename(path)
+        cached = self._cache_get(path)
+        if cached is not MISSING and immutable:
+            metrics.ATTACHMENTS_SERVED.inc("memory")
+            await client.send_file(destination, io.BytesIO(cached[1]), filename=filename)
+            return True
+
+        # Other files are checked, but only read again if they have changed.
+        result = await self._load(path, known=cached[0] if cached is not MISSING else None)
+        if result is None:
+            self.invalidate(path)
+            return False
+        key, data = result
+
+        if data is None or (cached is not MISSING and cached[0] == key):
+            metrics.ATTACHMENTS_SERVED.inc("memory")
+            await client.send_file(destination, io.BytesIO(cached[1]), filename=filename)
+            return True
+
+        if isinstance(data, bytes):
+            metrics.ATTACHMENTS_SERVED.inc("disk")
+            self._cache_put(path, key, data)
+            await client.send_file(destination, io.BytesIO(data), filename=filename)
+            return True
+
+        # A large file. Shared loads hand out the same mapping, so it can't be closed here.
+        metrics.ATTACHMENTS_SERVED.inc("mmap")
+        await client.send_file(destination, _MappedReader(data), filename=filename)
+        return True
+
+
+class _MappedReader(io.RawIOBase):
+    """
+    A read-only file object over a memory map, with its own position.
+    """
+
+    def __init__(self, mapped: mmap.mmap):
+        super().__init__()
+        self._view = memoryview(mapped)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        chunk = self._view[self._pos:self._pos + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+
+def get_server() -> AttachmentServer:
+    """
+    Gets the shared attachment server.
+    """
+    global _server
+    if _server is None:
+        _server = AttachmentServer()
+    return _server
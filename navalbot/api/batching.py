@@ -0,0 +1,142 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Coalesces concurrent redis reads.
+# Reads issued within the same loop iteration are deduplicated, and sent as a single pipeline.
+import asyncio
+import logging
+from collections import OrderedDict
+
+from navalbot.api import metrics, util
+
+logger = logging.getLogger("NavalBot")
+
+_batcher = None
+
+
+class ReadBatcher(object):
+    """
+    Collects redis reads made during one loop iteration, and runs them in one round trip.
+
+    Every caller reading the same key in the same iteration shares one result.
+    Each read is counted against the db function that asked for it, as the round trip itself is shared.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop or asyncio.get_event_loop()
+        self._pending = OrderedDict()
+
+        # Stats.
+        self.batches = 0
+        self.requests = 0
+        self.reads = 0
+
+    async def _wait(self, op: tuple, function: str):
+        self.requests += 1
+        metrics.REDIS_READS.inc(function)
+        fut = self._pending.get(op)
+        if fut is None:
+            if not self._pending:
+                # First read this iteration, so schedule the flush.
+                self.loop.call_soon(self._flush)
+            fut = self.loop.create_future()
+            self._pending[op] = fut
+        # Shield it, as other callers may be waiting on the same future.
+        return await asyncio.shield(fut)
+
+    def get(self, key: str, function: str = "get"):
+        """
+        Gets a string key. Batched into one MGET.
+        """
+        return self._wait(("get", key), function)
+
+    def hget(self, key: str, field: str, function: str = "hget"):
+        """
+        Gets a hash field. Batched into one HMGET per hash.
+        """
+        return self._wait(("hget", key, field), function)
+
+    def smembers(self, key: str, function: str = "smembers"):
+        """
+        Gets the members of a set.
+        """
+        return self._wait(("smembers", key), function)
+
+    def _flush(self):
+        batch, self._pending = self._pending, OrderedDict()
+        self.loop.create_task(self._execute(batch))
+
+    async def _execute(self, batch: OrderedDict):
+        self.batches += 1
+        self.reads += len(batch)
+
+        gets = []
+        hashes = OrderedDict()
+        sets = []
+        for op in batch:
+            if op[0] == "get":
+                gets.append(op[1])
+            elif op[0] == "hget":
+                hashes.setdefault(op[1], []).append(op[2])
+            else:
+                sets.append(op[1])
+
+        metrics.REDIS_BATCHED_READS.inc(amount=len(batch))
+        try:
+            pool = await util.get_pool()
+            async with pool.get() as conn:
+                pipe = conn.pipeline()
+                get_fut = pipe.mget(*gets) if gets else None
+                hash_futs = [(key, fields, pipe.hmget(key, *fields)) for (key, fields) in hashes.items()]
+                set_futs = [(key, pipe.smembers(key)) for key in sets]
+                with metrics.redis_call("read_batch"):
+                    await pipe.execute()
+
+                results = {}
+                if get_fut is not None:
+                    for key, value in zip(gets, await get_fut):
+                        results[("get", key)] = value
+                for key, fields, fut in hash_futs:
+                    for field, value in zip(fields, await fut):
+                        results[("hget", key, field)] = value
+                for key, fut in set_futs:
+                    results[("smembers", key)] = set(await fut)
+        except Exception as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for op, fut in batch.items():
+            if not fut.done():
+                fut.set_result(results[op])
+
+
+def get_batcher() -> ReadBatcher:
+    """
+    Gets the shared read batcher.
+    """
+    global _batcher
+    if _batcher is None:
+        _batcher = ReadBatcher()
+    return _batcher
@@ -0,0 +1,268 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# The user blacklist.
+# Lookups only ever touch an in-memory index. The index is rebuilt in the background, either when blacklist.json
+# changes on disk or, with the redis backend, when another shard changes a blacklist set.
+import asyncio
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import struct
+import sys
+
+from navalbot.api import db, metrics, util
+
+logger = logging.getLogger("NavalBot")
+
+# inotify constants, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _build_index(data) -> dict:
+    """
+    Builds the server_id -> frozenset of user IDs index from the blacklist.json structure.
+    """
+    if not isinstance(data, dict):
+        return {}
+    return {str(sid): frozenset(str(u) for u in users) for (sid, users) in data.items()}
+
+
+class Blacklist(object):
+    """
+    The user blacklist, indexed by server.
+    """
+
+    def __init__(self, path: str = "blacklist.json"):
+        cfg = util.get_global_config("blacklist", default={}) or {}
+        self.path = os.path.abspath(cfg.get("path", path))
+        self.backend = cfg.get("backend", "file")
+        self.poll_interval = float(cfg.get("poll_interval", 5))
+
+        # server_id -> frozenset of user IDs. This is only ever replaced, never mutated, so readers always see a
+        # complete index.
+        self.index = {}
+
+        self._started = False
+        self._mtime = None
+        self._reload_handle = None
+
+    def is_blacklisted(self, server_id: str, user_id: str) -> bool:
+        users = self.index.get(server_id)
+        return users is not None and user_id in users
+
+    # region file backend
+    def _read_file(self):
+        """
+        Reads the blacklist file. This blocks, so it's ran in an executor once the bot is up.
+        """
+        try:
+            with open(self.path) as f:
+                mtime = os.stat(f.fileno()).st_mtime
+                return mtime, _build_index(json.load(f))
+        except FileNotFoundError:
+            return None, {}
+
+    def load_file(self):
+        """
+        Loads the blacklist file synchronously. Used at startup.
+        """
+        self._mtime, self.index = self._read_file()
+
+    async def reload_file(self):
+        try:
+            mtime, index = await util.with_threading(self._read_file)
+        except (OSError, ValueError):
+            logger.exception("Failed to reload the blacklist, keeping the old one.")
+            return
+        self._mtime, self.index = mtime, index
+        logger.info("Reloaded the blacklist ({} servers).".format(len(index)))
+
+    def _write_file(self, data: dict):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        # Atomic, so the watcher never sees a half-written file.
+        os.replace(tmp, self.path)
+
+    def _schedule_reload(self, loop: asyncio.AbstractEventLoop):
+        # Editors tend to fire several events per save, so debounce them.
+        if self._reload_handle is not None:
+            self._reload_handle.cancel()
+        self._reload_handle = loop.call_later(0.1, lambda: loop.create_task(self.reload_file()))
+
+    def _watch_inotify(self, loop: asyncio.AbstractEventLoop) -> bool:
+        """
+        Watches the blacklist directory with inotify. Returns False if inotify isn't available.
+        """
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            # Watch the directory rather than the file, so replacing the file is seen too.
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MODIFY
+            if libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            loop.add_reader(fd, self._on_inotify, fd, loop)
+        except (OSError, AttributeError, NotImplementedError):
+            logger.warning("inotify is unavailable, polling the blacklist instead.")
+            return False
+        return True
+
+    def _on_inotify(self, fd: int, loop: asyncio.AbstractEventLoop):
+        name = os.path.basename(self.path).encode()
+        changed = False
+        while True:
+            try:
+                buf = os.read(fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                _, _, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                if buf[offset:offset + length].rstrip(b"\0") == name:
+                    changed = True
+                offset += length
+        if changed:
+            self._schedule_reload(loop)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                mtime = (await util.with_threading(lambda: os.stat(self.path))).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime != self._mtime:
+                await self.reload_file()
+
+    # endregion
+
+    # region redis backend
+    async def load_redis(self):
+        """
+        Loads every blacklist set from redis.
+        """
+        pool = await util.get_pool()
+        index = {}
+        async with pool.get() as conn:
+            cursor = 0
+            while True:
+                cursor, keys = await conn.scan(cursor, match="blacklist:*")
+                if keys:
+                    pipe = conn.pipeline()
+                    futs = [(key, pipe.smembers(key)) for key in keys]
+                    with metrics.redis_call("load_blacklist"):
+                        await pipe.execute()
+                    for key, fut in futs:
+                        index[key.decode().split(":", 1)[1]] = frozenset(u.decode() for u in await fut)
+                if cursor == 0:
+                    break
+        self.index = index
+        logger.info("Loaded the blacklist from redis ({} servers).".format(len(index)))
+
+    async def reload_server(self, server_id: str):
+        users = frozenset(await db.get_set("blacklist:{}".format(server_id)))
+        index = dict(self.index)
+        if users:
+            index[server_id] = users
+        else:
+            index.pop(server_id, None)
+        self.index = index
+
+    def _on_invalidation(self, server_id: str, key: str):
+        loop = asyncio.get_event_loop()
+        if server_id == "*":
+            loop.create_task(self.load_redis())
+        elif key == "blacklist":
+            loop.create_task(self.reload_server(server_id))
+
+    # endregion
+
+    async def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Starts keeping the index up to date. This is safe to call more than once.
+        """
+        if self._started:
+            return
+        self._started = True
+
+        if self.backend == "redis":
+            db.add_invalidation_handler(self._on_invalidation)
+            await self.load_redis()
+        elif not self._watch_inotify(loop):
+            loop.create_task(self._poll())
+
+    async def add(self, server_id: str, user_id: str):
+        """
+        Blacklists a user on a server.
+        """
+        await self._update(server_id, user_id, add=True)
+
+    async def remove(self, server_id: str, user_id: str):
+        """
+        Removes a user from the blacklist of a server.
+        """
+        await self._update(server_id, user_id, add=False)
+
+    async def _update(self, server_id: str, user_id: str, add: bool):
+        users = set(self.index.get(server_id, ()))
+        if add:
+            users.add(user_id)
+        else:
+            users.discard(user_id)
+
+        if self.backend == "redis":
+            pool = await util.get_pool()
+            async with pool.get() as conn:
+                if add:
+                    await conn.sadd("blacklist:{}".format(server_id), user_id)
+                else:
+                    await conn.srem("blacklist:{}".format(server_id), user_id)
+            await db.publish_invalidation(server_id, "blacklist")
+
+        index = dict(self.index)
+        if users:
+            index[server_id] = frozenset(users)
+        else:
+            index.pop(server_id, None)
+        self.index = index
+
+        if self.backend != "redis":
+            data = {sid: sorted(u) for (sid, u) in index.items()}
+            await util.with_threading(lambda: self._write_file(data))
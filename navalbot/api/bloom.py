@@ -0,0 +1,86 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Bloom filters.
+# These answer "definitely not" or "probably" for set membership, in constant time and very little memory.
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    """
+    A fixed size bloom filter.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        # Optimal bit and hash counts, for this capacity and false positive rate.
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.md5(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+    """
+    A bloom filter which grows, by adding a bigger filter whenever the current one is full.
+
+    Each new filter gets half the error rate of the last, so the total stays under error_rate.
+    """
+
+    def __init__(self, capacity: int = 64, error_rate: float = 0.01):
+        self.error_rate = error_rate
+        self.filters = [BloomFilter(capacity, error_rate / 2)]
+
+    def add(self, item: str):
+        current = self.filters[-1]
+        if current.full:
+            current = BloomFilter(current.capacity * 2, current.error_rate / 2)
+            self.filters.append(current)
+        current.add(item)
+
+    def __contains__(self, item: str) -> bool:
+        return any(item in f for f in self.filters)
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
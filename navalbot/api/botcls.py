@@ -22,27 +22,31 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 """
 
 # Subclass of discord.Client.
-import importlib
 import json
 import os
 import logging
 import traceback
-import shutil
 import sys
-import time
 
 import asyncio
-import yaml
 import discord
-from raven import Client
-from raven_aiohttp import AioHttpTransport
 
-from navalbot import builtins
-from navalbot.api import db
+from navalbot import builtins, exceptions
+from navalbot.api import db, factoids, filestore, permissions
 from navalbot.api.commands import commands, Command
-from navalbot.api import util
+from navalbot.api import executors, logs, metrics, outbound, pipeline, scheduler, settings, startup, util
+from navalbot.api.blacklist import Blacklist
+from navalbot.api.deletions import DeleteBatcher
+from navalbot.api.dispatch import HookDispatcher
+from navalbot.api.plugins import PluginLoader
+from navalbot.api.watchdog import LoopWatchdog
 
 logger = logging.getLogger("NavalBot")
+# Per-message lines go here, so they can be sampled separately.
+msg_logger = logging.getLogger(logs.MESSAGE_LOGGER)
+
+# The config keys loaded for every server message.
+MESSAGE_CONFIG_KEYS = ("command_prefix", "autodelete")
 
 
 class NavalClient(discord.Client):
@@ -53,17 +57,14 @@ class NavalClient(discord.Client):
 
     @classmethod
     def init_logging(cls):
-        if sys.platform == "win32":
-            logging.basicConfig(filename='nul', level=logging.INFO)
-        else:
-            logging.basicConfig(filename='/dev/null', level=logging.INFO)
-
         formatter = logging.Formatter('%(asctime)s - [%(levelname)s] %(name)s -> %(message)s')
         root = logging.getLogger()
+        root.setLevel(logging.INFO)
 
         consoleHandler = logging.StreamHandler()
         consoleHandler.setFormatter(formatter)
-        root.addHandler(consoleHandler)
+        # By default, the console is written to from a background thread.
+        logs.install(root, consoleHandler, util.get_global_config("logging", default={}) or {})
 
     def __new__(cls, *args, **kwargs):
         """
@@ -79,29 +80,70 @@ class NavalClient(discord.Client):
 
         self.modules = {}
         self.hooks = {}
-
-        if not os.path.exists("config.yml"):
-            shutil.copyfile("config.example.yml", "config.yml")
-
-        with open("config.yml", "r") as f:
-            self.config = yaml.load(f)
+        self.plugins = PluginLoader(self)
+        self.dispatcher = HookDispatcher(self.loop, self.hooks)
+        metrics.HOOK_QUEUE_DEPTH.set_function(self.dispatcher.queue.qsize)
+        self.outbound = outbound.OutboundDispatcher(self, super().send_message)
+        metrics.OUTBOUND_QUEUE_DEPTH.set_function(self.outbound.depth)
+        self.deleter = DeleteBatcher(self)
+        self.scheduler = scheduler.CommandScheduler(self.loop)
+        metrics.SCHEDULER_QUEUE_DEPTH.set_function(self.scheduler.depth)
+        metrics.SCHEDULER_RUNNING.set_function(lambda: self.scheduler.running)
+        self.watchdog = LoopWatchdog(self)
+        self.pipeline = pipeline.MessagePipeline()
+        self.add_default_stages()
+
+        self.config = settings.load()
 
         # Pre-load the blacklist.
-        if os.path.exists("blacklist.json"):
-            with open("blacklist.json") as f:
-                self.bl = json.load(f)
-                self.bl_mtime = os.stat(f.fileno()).st_mtime
-        else:
-            self.bl = []
-            self.bl_mtime = time.time()
+        self.blacklist = Blacklist()
+        if self.blacklist.backend == "file":
+            self.blacklist.load_file()
 
         # Create a client if the config says so.
         if self.config.get("use_sentry"):
             logger.info("Using Sentry for error reporting.")
+            from raven import Client
+            from raven_aiohttp import AioHttpTransport
             self._raven_client = Client(dsn=self.config.get("sentry_dsn"), transport=AioHttpTransport)
         else:
             self._raven_client = None
 
+    @property
+    def bl(self) -> dict:
+        """
+        The blacklist index, as server ID -> set of user IDs.
+        """
+        return self.blacklist.index
+
+    async def send_message(self, destination, content=None, *, priority: int = outbound.NORMAL, coalesce: bool = None,
+                           **kwargs):
+        """
+        Sends a message, through the outbound scheduler.
+
+        By default, results and errors are merged with other short replies waiting for the same channel.
+        Pass coalesce=False if you need the returned message to only contain this content.
+        """
+        if not self.outbound.enabled:
+            return await super().send_message(destination, content, **kwargs)
+        if coalesce is None:
+            coalesce = priority != outbound.NORMAL
+        return await self.outbound.send(destination, content, priority=priority, coalesce=coalesce, **kwargs)
+
+    async def logout(self):
+        """
+        Logs out, then stops the thread and process pools once their running calls have finished.
+
+        Queued config writes are flushed, and the metrics endpoint closed, first.
+        """
+        try:
+            await db.flush()
+        except Exception:
+            logger.exception("Could not flush config writes before logging out.")
+        await metrics.stop()
+        await super().logout()
+        await self.loop.run_in_executor(None, executors.shutdown)
+
     def __del__(self):
         # Fuck off asyncio
         self.loop.set_exception_handler(lambda *args, **kwargs: None)
@@ -112,8 +154,29 @@ class NavalClient(discord.Client):
 
         This is only used to dispatch to hooks.
         """
-        for hook in self.hooks.get("on_recv", []):
-            self.loop.create_task(hook(raw_data))
+        event = raw_data.get("t") if isinstance(raw_data, dict) else None
+        self.dispatcher.dispatch("on_recv", raw_data, event=event)
+
+    async def on_resumed(self):
+        # Role changes made while we were disconnected never arrive as member updates.
+        permissions.get_resolver().clear_members()
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        permissions.get_resolver().update_member(after)
+
+    async def on_member_remove(self, member: discord.Member):
+        permissions.get_resolver().remove_member(member)
+
+    async def on_server_role_update(self, before: discord.Role, after: discord.Role):
+        if before.name != after.name:
+            permissions.get_resolver().invalidate_server(after.server.id)
+
+    async def on_server_role_delete(self, role: discord.Role):
+        permissions.get_resolver().invalidate_server(role.server.id)
+
+    async def on_server_remove(self, server: discord.Server):
+        permissions.get_resolver().invalidate_server(server.id)
+        pipeline.get_index().forget(server.id)
 
     async def on_error(self, event_method, *args, **kwargs):
         """
@@ -127,47 +190,23 @@ class NavalClient(discord.Client):
             logger.error("Caught error in {}".format(event_method))
             traceback.print_exc()
 
-        # Run error hooks.
-        for hook in self.hooks.get("on_error", []):
-            self.loop.create_task(hook(event_method, *args, **kwargs))
+        # Run error hooks, including any appended to self.hooks by hand.
+        self.dispatcher.dispatch("on_error", event_method, *args, **kwargs)
 
     async def load_plugins(self):
         """
         Loads plugins from plugins/.
+
+        This only happens once per process, so reconnecting doesn't reload anything.
         """
-        if not os.path.exists(os.path.join(os.getcwd(), "plugins/")):
-            logger.critical("No plugins directory exists. Your bot is effectively useless.")
-            return
-        # Loop over things in plugins/
-        for entry in os.scandir("plugins/"):
-            if entry.name == "__pycache__" or entry.name == "__init__.py":
-                continue
-            if entry.name.endswith(".py"):
-                name = entry.name.split(".")[0]
-            else:
-                if os.path.isdir(entry.path) or os.path.islink(entry.path):
-                    name = entry.name
-                else:
-                    continue
-            import_name = "plugins." + name
-            # Import using importlib.
-            try:
-                mod = importlib.import_module(import_name)
-                if hasattr(mod, "load_plugin"):
-                    await mod.load_plugin(self)
-                self.modules[mod.__name__] = mod
-                logger.info("Loaded plugin {} (from {})".format(mod.__name__, mod.__file__))
-            except Exception as e:
-                logger.error("Error upon loading plugin `{}`! Cannot continue loading.".format(import_name))
-                traceback.print_exc()
-                return
+        await self.plugins.load_all()
 
     async def on_ready(self):
         # Get the OAuth2 URL, or something
         if self.user.bot:
             bot_id = self.config.get("client", {}).get("oauth_client_id")
-            permissions = discord.Permissions.all_channel()
-            oauth_url = discord.utils.oauth_url(str(bot_id), permissions=permissions)
+            invite_permissions = discord.Permissions.all_channel()
+            oauth_url = discord.utils.oauth_url(str(bot_id), permissions=invite_permissions)
             if bot_id is None:
                 logger.critical("You didn't set the bot ID in config.yml. Your bot cannot be invited anywhere.")
                 sys.exit(1)
@@ -177,11 +216,32 @@ class NavalClient(discord.Client):
 
         # print ready msg
         logger.info("Loaded NavalBot, logged in as `{}`.".format(self.user.name))
+        # Role changes made while we were disconnected never arrive as member updates.
+        permissions.get_resolver().clear_members()
         # make file dir
         try:
             os.makedirs(os.path.join(os.getcwd(), "files"))
         except FileExistsError:
             pass
+        # Load the file store index now, rather than on the first factoid.
+        filestore.get_store()
+
+        # Listen for config changes from other shards.
+        db.start_invalidation_listener(self.loop)
+
+        # Start the loop lag probe, and the metrics endpoint if enabled.
+        await metrics.start(self.loop, self.config.get("metrics", {}) or {})
+        # Watch for anything blocking the loop.
+        self.watchdog.start()
+
+        # Start the hook workers.
+        self.dispatcher.start()
+
+        # Keep the blacklist up to date.
+        await self.blacklist.start(self.loop)
+
+        # Build the factoid filter in the background. Until it is built, every lookup goes to redis.
+        self.loop.create_task(factoids.get_filter().build())
 
         # Load plugins
         await self.load_plugins()
@@ -189,89 +249,30 @@ class NavalClient(discord.Client):
         # Set the game.
         await self.change_status(discord.Game(name="Type ?info for help!"))
 
+        # Everything since the client was created was logging in, connecting, and the above.
+        startup.mark("connect and ready")
+        startup.report()
+
     async def on_message(self, message: discord.Message):
         # Increment the message count.
         util.msgcount += 1
+        metrics.MESSAGES.inc()
 
-        if message.author.bot:
-            logger.info("Ignoring message from bot account.")
-            return
-
-        if not isinstance(message.channel, discord.PrivateChannel):
-            # print(Fore.RED + message.server.name, ":", Fore.GREEN + message.channel.name, ":",
-            #      Fore.CYAN + message.author.name , ":", Fore.RESET + message.content)
-            logger.info("Recieved message: {message.content} from {message.author.name}".format(message=message))
-            logger.info(" On channel: #{message.channel.name}".format(message=message))
-
-        # Check if it matches the command prefix.
-        if message.author.id == self.user.id:
-            logger.info("Not processing own message.")
-            return
-
-        # Re-process the blacklist.
-        if os.path.exists("blacklist.json"):
-            # Get the time
-            mtime = os.stat("blacklist.json").st_mtime
-            if mtime > self.bl_mtime:
-                logger.debug("Blacklist file changed, reloading...")
-                # Update mtime
-                self.bl_mtime = mtime
-                # Reload blacklist
-                with open("blacklist.json") as f:
-                    self.bl = json.load(f)
-
-        # Check for a valid server.
-        if message.server is not None:
-            prefix = await db.get_config(message.server.id, "command_prefix", "?")
-            autodelete = True if await db.get_config(message.server.id, "autodelete") == "True" else False
-            if autodelete and message.content.startswith(prefix):
-                await self.delete_message(message)
-            logger.info(" On server: {} ({})".format(message.server.name, message.server.id))
-        else:
-            # No DMs
-            await self.send_message(message.channel, "I don't accept private messages.")
-            return
-
-        if message.server.id in self.bl:
-            bb = self.bl[message.server.id]
-            if message.author.id in bb:
-                # Ignore message
-                logger.warn("Ignoring message, as user is on the blacklist.")
-                return
+        await self.pipeline.run(self, message)
 
-        if len(message.content) == 0:
-            logger.info("Ignoring (presumably) image-only message.")
-            return
-
-        # Run on_message hooks
-        # for hook in cmds.message_hooks.values():
-        #    logger.info("Running hook {}".format(hook.__name__))
-        #    try:
-        #        await hook(client, message)
-        #    except StopProcessing:
-        #        return
-
-        # Run on_message hooks.
-        for hook in self.hooks.get("on_message", []):
-            self.loop.create_task(hook(self, message))
-
-        if message.content.startswith(prefix):
-            cmd_content = message.content[len(prefix):]
-            cmd_word = cmd_content.split(" ")[0].lower()
-            try:
-                coro = commands[cmd_word]
-            except KeyError as e:
-                logger.warning("-> No such command: " + str(e))
-                coro = builtins.default
-            try:
-                if isinstance(coro, Command):
-                    await coro.invoke(self, message)
-                else:
-                    await coro(self, message)
-            except Exception as e:
-                await self.send_message(message.channel, content="```\n{}\n```".format(traceback.format_exc()))
-                # Allow it to fall through.
-                raise
+    def add_default_stages(self):
+        """
+        Adds the built-in message stages. Plugins can add their own around them with self.pipeline.add().
+        """
+        self.pipeline.add(_ignore_bots, pipeline.MEMORY, "bots")
+        self.pipeline.add(_refuse_private, pipeline.MEMORY, "private")
+        self.pipeline.add(_log_message, pipeline.MEMORY, "log")
+        self.pipeline.add(_check_blacklist, pipeline.MEMORY, "blacklist")
+        self.pipeline.add(_ignore_empty, pipeline.MEMORY, "empty")
+        self.pipeline.add(_dispatch_hooks, pipeline.MEMORY, "hooks")
+        self.pipeline.add(_check_prefix, pipeline.MEMORY, "prefix")
+        self.pipeline.add(_load_config, pipeline.IO, "config")
+        self.pipeline.add(_run_command, pipeline.COMMAND, "command")
 
     def navalbot(self):
         # Switch login method based on args.
@@ -307,3 +308,105 @@ class NavalClient(discord.Client):
                 traceback.print_exc()
                 logger.error("Crashed. Don't know how, don't care. Continuing..")
                 continue
+
+
+# region message stages
+def _ignore_bots(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    if message.author.bot:
+        msg_logger.info("Ignoring message from bot account.")
+        raise exceptions.StopProcessing
+    if message.author.id == client.user.id:
+        msg_logger.info("Not processing own message.")
+        raise exceptions.StopProcessing
+
+
+async def _refuse_private(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    if message.server is None:
+        # No DMs
+        await client.send_message(message.channel, "I don't accept private messages.", priority=outbound.ERROR)
+        raise exceptions.StopProcessing
+
+
+def _log_message(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    msg_logger.info("Recieved message: %s from %s", message.content, message.author.name)
+    msg_logger.info(" On channel: #%s", message.channel.name)
+    msg_logger.info(" On server: %s (%s)", message.server.name, message.server.id)
+
+
+def _check_blacklist(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    if client.blacklist.is_blacklisted(message.server.id, message.author.id):
+        msg_logger.warning("Ignoring message, as user is on the blacklist.")
+        raise exceptions.StopProcessing
+
+
+def _ignore_empty(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    if len(message.content) == 0:
+        msg_logger.info("Ignoring (presumably) image-only message.")
+        raise exceptions.StopProcessing
+
+
+def _dispatch_hooks(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    # Hooks see every message, commands or not.
+    client.dispatcher.dispatch("on_message", client, message)
+
+
+def _check_prefix(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    # Plain chat stops here, without touching redis.
+    if not pipeline.get_index().might_be_command(message.server.id, message.content):
+        raise exceptions.StopProcessing
+
+
+async def _load_config(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    index = pipeline.get_index()
+    changes = index.changes
+    # Load everything we need in one go.
+    config = context.config = await db.get_server_config(message.server.id, MESSAGE_CONFIG_KEYS)
+    prefix = context.prefix = config.get("command_prefix", "?")
+    index.learn(message.server.id, prefix, changes)
+    if not message.content.startswith(prefix):
+        raise exceptions.StopProcessing
+    if config.get("autodelete") == "True":
+        # Deleted in the background, in bulk.
+        client.deleter.delete(message)
+
+
+async def _run_command(client: NavalClient, message: discord.Message, context: pipeline.MessageContext):
+    cmd_content = message.content[len(context.prefix):]
+    cmd_word = cmd_content.split(" ")[0].lower()
+    try:
+        coro = commands[cmd_word]
+    except KeyError as e:
+        msg_logger.warning("-> No such command: %s", e)
+        coro = builtins.default
+    # Wait for a slot, so one busy server can't hold up the others.
+    is_owner = int(message.author.id) == util.get_global_config("RCE_ID", default=0, type_=int)
+    try:
+        ticket = await client.scheduler.acquire(message.server.id, getattr(coro, "name", cmd_word),
+                                                limit=getattr(coro, "_concurrency", None), owner=is_owner)
+    except exceptions.CommandError as e:
+        await client.send_message(message.channel, e.message, priority=outbound.ERROR)
+        return
+    try:
+        if isinstance(coro, Command):
+            await coro.invoke(client, message, config=context.config)
+        elif coro is builtins.default:
+            await coro(client, message, config=context.config)
+        else:
+            # Legacy function commands.
+            metrics.COMMAND_CALLS.inc(cmd_word)
+            try:
+                with metrics.timer(metrics.COMMAND_LATENCY, cmd_word):
+                    await coro(client, message)
+            except Exception:
+                metrics.COMMAND_ERRORS.inc(cmd_word)
+                raise
+    except Exception:
+        await client.send_message(message.channel, content="```\n{}\n```".format(traceback.format_exc()),
+                                  priority=outbound.ERROR)
+        # Allow it to fall through.
+        raise
+    finally:
+        client.scheduler.release(ticket)
+
+
+# endregion
@@ -0,0 +1,86 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Small in-process caches.
+from collections import OrderedDict
+
+# Sentinel returned when a key is not in a cache.
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry once it is full.
+
+    This is not thread-safe; it is only meant to be used from the event loop.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=MISSING):
+        """
+        Gets a key from the cache, marking it as recently used.
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Puts a key into the cache, evicting the oldest entry if required.
+        """
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def peek(self, key, default=MISSING):
+        """
+        Gets a key from the cache without touching its recency or the hit counters.
+        """
+        return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def keys(self):
+        return list(self._data.keys())
@@ -24,6 +24,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 """
 
 from .cmdclass import Command
+from . import converters
 
 commands = {}
 
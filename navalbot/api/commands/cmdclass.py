@@ -25,8 +25,23 @@ import shlex
 import discord
 
 from navalbot import exceptions
-from navalbot.api import util
+from navalbot.api import db, metrics, outbound, util
 from navalbot.api.util import has_permissions_with_override
+from navalbot.api.commands import converters
+
+
+async def _load_config(server_id: str) -> db.ServerConfig:
+    """
+    Loads the config for a command invoked outside of the message pipeline.
+
+    This is the whole config with hash storage, and otherwise the same keys the pipeline loads. Use config.fetch()
+    for anything else.
+    """
+    if db._hash_mode():
+        return await db.get_server_config(server_id)
+    # Imported here, as botcls imports the commands.
+    from navalbot.api.botcls import MESSAGE_CONFIG_KEYS
+    return await db.get_server_config(server_id, MESSAGE_CONFIG_KEYS)
 
 
 class Command(object):
@@ -42,8 +57,13 @@ class Command(object):
     def __init__(self, to_wrap, *names, **kwargs):
         # Declare everything
         self.names = names
+        self.name = names[0] if names else to_wrap.__name__
         self._wrapped_coro = to_wrap
 
+        # Commands can ask for the message's config snapshot with a keyword-only `config` argument.
+        param = inspect.signature(to_wrap).parameters.get("config")
+        self._wants_config = param is not None and param.kind == inspect.Parameter.KEYWORD_ONLY
+
         self._parse_kwargs(**kwargs)
 
     def _parse_kwargs(self, **kwargs):
@@ -60,6 +80,7 @@ class Command(object):
             else:
                 self._args_type = 1
                 self._args_count = int(kwargs["argcount"])
+                self._compile_converters()
 
             self._arg_error_msg = kwargs.get(
                 "argerror",
@@ -80,16 +101,43 @@ class Command(object):
         else:
             self._only_owner = False
 
+        # How many calls of this command can run at once, across every server. None is unlimited.
+        self._concurrency = kwargs.get("concurrency")
+
+    def _compile_converters(self):
+        """
+        Checks the arity of the function, and looks up the converter for each argument, once.
+        """
+        params = [p for p in inspect.signature(self._wrapped_coro).parameters.values()
+                  if p.kind != inspect.Parameter.KEYWORD_ONLY]
+        if len(params) != (2 + self._args_count):
+            raise exceptions.BadCommandException("Arg count of {} differs from number of requested args ({})"
+                                                 .format(len(params), 2 + self._args_count))
+        plan = tuple(converters.get_converter(p.annotation) for p in params[2:])
+        # Untyped commands skip conversion entirely.
+        self._converters = plan if any(c is not None for c in plan) else None
+
     def help(self):
         """
         Get the help for a specific function.
         """
         return self._wrapped_coro.__doc__
 
-    async def invoke(self, client: discord.Client, message: discord.Message):
+    async def invoke(self, client: discord.Client, message: discord.Message, config: db.ServerConfig = None):
         """
         Invoke the function.
+
+        `config` is the server config snapshot already loaded for this message, if any.
         """
+        metrics.COMMAND_CALLS.inc(self.name)
+        try:
+            with metrics.timer(metrics.COMMAND_LATENCY, self.name):
+                return await self._invoke(client, message, config)
+        except Exception:
+            metrics.COMMAND_ERRORS.inc(self.name)
+            raise
+
+    async def _invoke(self, client: discord.Client, message: discord.Message, config: db.ServerConfig):
         # Do the checks before running the coroutine.
         # Owner check.
 
@@ -98,7 +146,8 @@ class Command(object):
             u_id = int(message.author.id)
             # Check if it is in the ids specified.
             if not u_id == owner:
-                await client.send_message(message.channel, ":no_entry: This command is restricted to bot owners.")
+                await client.send_message(message.channel, ":no_entry: This command is restricted to bot owners.",
+                                          priority=outbound.ERROR)
                 return
         # Role check.
 
@@ -108,13 +157,15 @@ class Command(object):
             try:
                 assert isinstance(message.author, discord.Member)
             except AssertionError:
-                await client.send_message(message.channel, ":no_entry: Cannot determine your role!")
+                await client.send_message(message.channel, ":no_entry: Cannot determine your role!",
+                                          priority=outbound.ERROR)
                 return
             if not await has_permissions_with_override(message.author, allowed_roles, message.server.id,
                                                        self._wrapped_coro.__name__):
                 await client.send_message(
                     message.channel,
-                    ":no_entry: You do not have any of the required roles: `{}`!".format(allowed_roles)
+                    ":no_entry: You do not have any of the required roles: `{}`!".format(allowed_roles),
+                    priority=outbound.ERROR
 
                 )
                 return
@@ -128,44 +179,35 @@ class Command(object):
                 except ValueError:
                     args = message.content.split(" ")[1:]
                 if len(args) < 1:
-                    await client.send_message(message.channel, self._arg_error_msg)
+                    await client.send_message(message.channel, self._arg_error_msg, priority=outbound.ERROR)
                     return
             elif self._args_type == 1:
-                # Check the function for annotations.
-                func_sig = inspect.signature(self._wrapped_coro)
-                if len(func_sig.parameters) != (2 + self._args_count):
-                    raise exceptions.BadCommandException("Arg count of {} differs from number of requested args ({})"
-                                                         .format(len(func_sig.parameters), 2 + self._args_count))
-                # Get the annotations, if applicable.
-                params = list(func_sig.parameters.values())
-                annotations = [f.annotation for f in params[2:]]
-                temp_args = shlex.split(message.content)[1:]
-                if len(temp_args) != self._args_count:
-                    await client.send_message(message.channel, self._arg_error_msg)
+                args = shlex.split(message.content)[1:]
+                if len(args) != self._args_count:
+                    await client.send_message(message.channel, self._arg_error_msg, priority=outbound.ERROR)
                     return
-                args = []
-                # match the annotations
-                for arg, ann in zip(temp_args, annotations):
-                    if ann == inspect.Parameter.empty:
-                        args.append(arg)
-                    else:
-                        # Nested doom
-                        if isinstance(ann, type):
-                            if ann.__name__ == "bool":
-                                args.append(False if arg == "False" else True)
-                            else:
-                                try:
-                                    args.append(ann(arg))
-                                except ValueError:
-                                    await client.send_message(message.channel, ":x: One of your arguments was the "
-                                                                               "wrong type.")
-                                    return
+                if self._converters is not None:
+                    try:
+                        args = [arg if conv is None else conv(arg, message)
+                                for (arg, conv) in zip(args, self._converters)]
+                    except exceptions.CommandError as e:
+                        await client.send_message(message.channel, e.message, priority=outbound.ERROR)
+                        return
+                    except (ValueError, TypeError):
+                        await client.send_message(message.channel, ":x: One of your arguments was the wrong type.",
+                                                  priority=outbound.ERROR)
+                        return
 
         # Now that we've gotten all of the returns out of the way, invoke the coroutine.
+        kwargs = {}
+        if self._wants_config:
+            if config is None:
+                config = await _load_config(message.server.id)
+            kwargs["config"] = config
         if hasattr(self, "_args_type"):
-            result = await self._wrapped_coro(client, message, *args)
+            result = await self._wrapped_coro(client, message, *args, **kwargs)
         else:
-            result = await self._wrapped_coro(client, message)
+            result = await self._wrapped_coro(client, message, **kwargs)
 
         if result:
-            await client.send_message(message.channel, result)
+            await client.send_message(message.channel, result, priority=outbound.RESULT)
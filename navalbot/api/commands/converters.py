@@ -0,0 +1,205 @@
+"""
+Argument converters.
+
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Converters turn one argument of an `argcount=N` command into the type its annotation asks for.
+# They are looked up once, when the command is registered, so a call only runs them.
+#
+# An annotation can be:
+#  - a type with a registered converter, such as bool, discord.Member, discord.Channel or discord.Role
+#  - an enum.Enum subclass, matched by member name
+#  - a Converter instance, such as Integer(1, 10) or Choice("on", "off")
+#  - any other type or callable, which is called with the argument
+#
+# A converter is called with (argument, message). It raises CommandError to reply with its own message, or
+# ValueError to reply with the generic wrong type message.
+import enum
+import inspect
+import re
+
+import discord
+
+from navalbot import exceptions
+
+# type -> converter
+_converters = {}
+
+_mention = re.compile(r'<(@!?|@&|#)(\d+)>$')
+
+
+def _parse_mention(arg: str, kinds: tuple):
+    """
+    Gets the ID out of a mention of one of these kinds, or None if it isn't one.
+    """
+    match = _mention.match(arg)
+    if match and match.group(1) in kinds:
+        return match.group(2)
+    return None
+
+
+def _server(message: discord.Message) -> discord.Server:
+    if message.server is None:
+        raise exceptions.CommandError(":x: This command only works in a server.")
+    return message.server
+
+
+class Converter(object):
+    """
+    The base converter class. Subclasses override convert().
+    """
+
+    def convert(self, arg: str, message: discord.Message):
+        raise NotImplementedError
+
+    def __call__(self, arg: str, message: discord.Message):
+        return self.convert(arg, message)
+
+
+class Integer(Converter):
+    """
+    An integer between minimum and maximum, inclusive.
+    """
+
+    def __init__(self, minimum: int = None, maximum: int = None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def convert(self, arg: str, message: discord.Message):
+        value = int(arg)
+        if (self.minimum is not None and value < self.minimum) or (self.maximum is not None and value > self.maximum):
+            raise exceptions.CommandError(":x: `{}` must be between {} and {}.".format(
+                value, "-∞" if self.minimum is None else self.minimum,
+                "∞" if self.maximum is None else self.maximum))
+        return value
+
+
+class Choice(Converter):
+    """
+    One of a set of strings, ignoring case.
+    """
+
+    def __init__(self, *choices):
+        self.choices = {c.lower(): c for c in choices}
+
+    def convert(self, arg: str, message: discord.Message):
+        try:
+            return self.choices[arg.lower()]
+        except KeyError:
+            raise exceptions.CommandError(":x: `{}` must be one of: `{}`.".format(
+                arg, "`, `".join(self.choices.values())))
+
+
+class EnumConverter(Converter):
+    """
+    A member of an enum, by name, ignoring case.
+    """
+
+    def __init__(self, enum_type: type):
+        self.enum_type = enum_type
+        self.members = {name.lower(): member for (name, member) in enum_type.__members__.items()}
+
+    def convert(self, arg: str, message: discord.Message):
+        try:
+            return self.members[arg.lower()]
+        except KeyError:
+            raise exceptions.CommandError(":x: `{}` must be one of: `{}`.".format(
+                arg, "`, `".join(m.name for m in self.enum_type)))
+
+
+class MemberConverter(Converter):
+    """
+    A member of the server, by mention, ID or name.
+    """
+
+    def convert(self, arg: str, message: discord.Message):
+        server = _server(message)
+        member_id = _parse_mention(arg, ("@", "@!"))
+        member = server.get_member(member_id or arg) or server.get_member_named(arg)
+        if member is None:
+            raise exceptions.CommandError(":x: Could not find member `{}`.".format(arg))
+        return member
+
+
+class ChannelConverter(Converter):
+    """
+    A channel of the server, by mention, ID or name.
+    """
+
+    def convert(self, arg: str, message: discord.Message):
+        server = _server(message)
+        channel_id = _parse_mention(arg, ("#",))
+        channel = server.get_channel(channel_id or arg) or discord.utils.get(server.channels, name=arg.lstrip("#"))
+        if channel is None:
+            raise exceptions.CommandError(":x: Could not find channel `{}`.".format(arg))
+        return channel
+
+
+class RoleConverter(Converter):
+    """
+    A role of the server, by mention, ID or name.
+    """
+
+    def convert(self, arg: str, message: discord.Message):
+        server = _server(message)
+        role_id = _parse_mention(arg, ("@&",)) or arg
+        for role in server.roles:
+            if role.id == role_id or role.name == arg:
+                return role
+        raise exceptions.CommandError(":x: Could not find role `{}`.".format(arg))
+
+
+def register(type_: type, converter):
+    """
+    Makes arguments annotated with type_ use this converter, for commands registered afterwards.
+    """
+    _converters[type_] = converter
+
+
+def get_converter(annotation):
+    """
+    Gets the converter for an annotation, or None if the argument is passed as it is.
+
+    Raises a BadCommandException if the annotation can't be used to convert anything.
+    """
+    if annotation is inspect.Parameter.empty or annotation is str:
+        return None
+    if isinstance(annotation, Converter):
+        return annotation
+    if isinstance(annotation, type):
+        converter = _converters.get(annotation)
+        if converter is not None:
+            return converter
+        if issubclass(annotation, enum.Enum):
+            return EnumConverter(annotation)
+        return lambda arg, message: annotation(arg)
+    if callable(annotation):
+        return lambda arg, message: annotation(arg)
+    raise exceptions.BadCommandException("Cannot convert arguments to {!r}".format(annotation))
+
+
+register(bool, lambda arg, message: arg != "False")
+register(discord.Member, MemberConverter())
+register(discord.User, MemberConverter())
+register(discord.Channel, ChannelConverter())
+register(discord.Role, RoleConverter())
@@ -21,53 +21,414 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 """
 
 # This handles aioredis DB stuff.
+import asyncio
+import logging
+import uuid
 
-from navalbot.api import util
+from navalbot.api import batching, metrics, util, writes
+from navalbot.api.cache import LRUCache, MISSING
 
-async def get_config(server_id: str, key: str, default=None, type_: type=str) -> str:
+logger = logging.getLogger("NavalBot")
+
+# The pub/sub channel used to tell every shard that a config key has changed.
+INVALIDATION_CHANNEL = "navalbot:config:invalidate"
+
+# Identifies this process on the invalidation channel, so we can skip our own messages.
+_process_token = uuid.uuid4().hex
+
+# server_id -> LRUCache of key -> raw value, or None if the key does not exist.
+# This is created lazily, as the global config isn't loaded when this module is imported.
+_config_cache = None
+
+# Bumped whenever cached data is invalidated, so that reads which were in flight at the time don't store stale data.
+_epoch = 0
+_generations = {}
+
+_listener_task = None
+
+# Callbacks for invalidations. See add_invalidation_handler().
+_invalidation_handlers = []
+
+# Set by the migration tool once every old per-key setting has been moved into hashes.
+MIGRATED_KEY = "navalbot:storage:migrated"
+
+# Whether MIGRATED_KEY is set. None means we haven't checked yet.
+_migrated = None
+
+
+def _get_cache() -> LRUCache:
+    global _config_cache
+    if _config_cache is None:
+        cfg = util.get_global_config("cache", default={}) or {}
+        _config_cache = LRUCache(maxsize=int(cfg.get("max_servers", 2048)))
+    return _config_cache
+
+
+def _generation(server_id: str) -> tuple:
+    return _epoch, _generations.get(server_id, 0)
+
+
+def _cached(server_id: str, key: str):
+    server = _get_cache().get(server_id)
+    if server is MISSING:
+        return MISSING
+    return server.get(key)
+
+
+def _cache_store(server_id: str, key: str, value):
+    cache = _get_cache()
+    server = cache.get(server_id)
+    if server is MISSING:
+        cfg = util.get_global_config("cache", default={}) or {}
+        server = LRUCache(maxsize=int(cfg.get("max_keys_per_server", 256)))
+        cache.put(server_id, server)
+    server.put(key, value)
+
+
+def invalidate(server_id: str, key: str = None):
     """
-    Gets a config from the redis DB.
+    Drops a cached config value, or every cached value for a server if no key is given.
+    """
+    _generations[server_id] = _generations.get(server_id, 0) + 1
+    if key is None:
+        _get_cache().pop(server_id)
+        return
+    server = _get_cache().peek(server_id)
+    if server is not MISSING:
+        server.pop(key)
+
+
+def invalidate_all():
+    """
+    Drops the entire config cache, and forgets the storage layout state.
+    """
+    global _epoch, _migrated
+    _epoch += 1
+    _migrated = None
+    _get_cache().clear()
+    _run_invalidation_handlers("*", None)
+
+
+def add_invalidation_handler(func):
+    """
+    Registers a callback for invalidations, so that other caches can follow them.
+
+    It is called with (server_id, key) for every config change, whether it was made here or by another shard, and with
+    ("*", None) whenever everything should be dropped.
+    """
+    _invalidation_handlers.append(func)
+
+
+def _run_invalidation_handlers(server_id: str, key: str):
+    for handler in _invalidation_handlers:
+        try:
+            handler(server_id, key)
+        except Exception:
+            logger.exception("Error in invalidation handler {}".format(handler))
+
+
+async def publish_invalidation(server_id: str, key: str = None):
+    """
+    Tells every other shard that something has changed.
     """
     pool = await util.get_pool()
-    # Get the value of config:server_id:key.
-    built = "config:{sid}:{key}".format(sid=server_id, key=key)
     async with pool.get() as conn:
-        if not await conn.exists(built):
-            return default
-        else:
-            data = await conn.get(built)
+        with metrics.redis_call("publish_invalidation"):
+            await conn.publish(INVALIDATION_CHANNEL, _build_invalidation(server_id, key))
+
+
+def _build_invalidation(server_id: str, key: str = None) -> str:
+    return "{token}:{sid}:{key}".format(token=_process_token, sid=server_id, key=key or "")
+
+
+def _handle_invalidation(data: bytes):
+    try:
+        token, server_id, key = data.decode().split(":", 2)
+    except ValueError:
+        logger.warning("Malformed config invalidation message: {}".format(data))
+        return
+    if token == _process_token:
+        # We already invalidated this locally.
+        return
+    if server_id == "*":
+        # Sent when the storage layout changes.
+        invalidate_all()
+        return
+    invalidate(server_id, key or None)
+    _run_invalidation_handlers(server_id, key or None)
+
+
+async def _listen_for_invalidations():
+    delay = 1
+    while True:
+        try:
+            conn = await util.create_redis()
             try:
-                return type_(data.decode())
-            except (ValueError, AttributeError):
-                return default
+                channel, = await conn.subscribe(INVALIDATION_CHANNEL)
+                # Anything could have changed while we weren't subscribed.
+                invalidate_all()
+                delay = 1
+                while await channel.wait_message():
+                    _handle_invalidation(await channel.get())
+            finally:
+                conn.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Config invalidation listener failed, reconnecting in {}s.".format(delay))
+        # Drop everything, as we can't hear about changes until we reconnect.
+        invalidate_all()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
 
-async def set_config(server_id: str, key: str, value: str):
+
+def start_invalidation_listener(loop: asyncio.AbstractEventLoop = None) -> asyncio.Task:
     """
-    Sets a config in the redis DB.
+    Starts listening for config changes made by other shards.
+
+    This is safe to call more than once.
     """
+    global _listener_task
+    if _listener_task is None or _listener_task.done():
+        loop = loop or asyncio.get_event_loop()
+        _listener_task = loop.create_task(_listen_for_invalidations())
+    return _listener_task
+
+
+def _hash_mode() -> bool:
+    """
+    Checks if settings are stored as one hash per server, rather than one key per setting.
+    """
+    return util.get_global_config("redis", default={}).get("storage", "keys") == "hash"
+
+
+def _legacy_key(server_id: str, key: str) -> str:
+    return "config:{sid}:{key}".format(sid=server_id, key=key)
+
+
+def _hash_key(server_id: str) -> str:
+    return "config:{sid}".format(sid=server_id)
+
+
+async def _is_migrated() -> bool:
+    """
+    Checks if the migration to hash storage has finished.
+
+    Until it has, hash reads fall back to the old per-key layout.
+    """
+    global _migrated
+    if _migrated is None:
+        _migrated = bool(await batching.get_batcher().get(MIGRATED_KEY, "is_migrated"))
+    return _migrated
+
+
+def _decode(value):
+    return value.decode() if value is not None else None
+
+
+def _convert(value, default, type_: type):
+    if value is None:
+        return default
+    try:
+        return type_(value)
+    except ValueError:
+        return default
+
+
+async def _fetch(server_id: str, keys: list, function: str) -> list:
+    """
+    Fetches raw config values from redis.
+
+    These go through the read batcher, so every read made in this loop iteration shares one round trip.
+    The reads are counted against `function`, the public db function they were made for.
+    Missing keys are returned as None.
+    """
+    batcher = batching.get_batcher()
+    if _hash_mode():
+        hash_key = _hash_key(server_id)
+        reads = [batcher.hget(hash_key, key, function) for key in keys]
+        fallback = not await _is_migrated()
+        if fallback:
+            reads += [batcher.get(_legacy_key(server_id, key), function) for key in keys]
+        values = await asyncio.gather(*reads)
+        if fallback:
+            hashed, legacy = values[:len(keys)], values[len(keys):]
+            values = [h if h is not None else l for (h, l) in zip(hashed, legacy)]
+    else:
+        values = await asyncio.gather(*[batcher.get(_legacy_key(server_id, key), function) for key in keys])
+
+    return [_decode(value) for value in values]
+
+
+async def _get_raw(server_id: str, keys, function: str) -> dict:
+    """
+    Gets raw config values, using unflushed writes and the cache where possible, and one round trip for the rest.
+    """
+    # An empty buffer is falsy, so the usual case skips it.
+    buffer = writes.get_buffer()
+    result = {}
+    missing = []
+    for key in keys:
+        value = buffer.get(server_id, key) if buffer else MISSING
+        if value is MISSING:
+            value = _cached(server_id, key)
+        if value is MISSING:
+            missing.append(key)
+        else:
+            result[key] = value
+
+    if missing:
+        generation = _generation(server_id)
+        values = await _fetch(server_id, missing, function)
+        store = _generation(server_id) == generation
+        for key, value in zip(missing, values):
+            # A write may have been queued while this was fetched.
+            pending = buffer.get(server_id, key) if buffer else MISSING
+            if pending is not MISSING:
+                result[key] = pending
+                continue
+            result[key] = value
+            if store:
+                _cache_store(server_id, key, value)
+
+    return result
+
+
+class ServerConfig(object):
+    """
+    A snapshot of some, or all, of a server's config.
+
+    This is loaded in one go with get_server_config(), and can then be read without touching redis.
+    """
+
+    def __init__(self, server_id: str, values: dict, complete: bool = False):
+        self.server_id = server_id
+        self.complete = complete
+        self._values = values
+
+    def __contains__(self, key: str):
+        return self.complete or key in self._values
+
+    def get(self, key: str, default=None, type_: type=str):
+        """
+        Gets a config value from the snapshot.
+
+        Raises a KeyError if the key was not loaded into this snapshot.
+        """
+        if key not in self._values:
+            if not self.complete:
+                raise KeyError("Config key `{}` is not part of this snapshot".format(key))
+            return default
+        return _convert(self._values[key], default, type_)
+
+    async def fetch(self, key: str, default=None, type_: type=str):
+        """
+        Gets a config value from the snapshot, falling back to get_config() for keys that weren't loaded.
+        """
+        if key in self:
+            return self.get(key, default, type_)
+        return await get_config(self.server_id, key, default, type_)
+
+
+async def get_server_config(server_id: str, keys=None) -> ServerConfig:
+    """
+    Loads a snapshot of a server's config.
+
+    If keys is None, the entire server config is loaded with a HGETALL. This requires hash storage.
+    """
+    if keys is not None:
+        return ServerConfig(server_id, await _get_raw(server_id, keys, "get_server_config"))
+
+    if not _hash_mode():
+        raise ValueError("Loading an entire server config requires `storage: hash`")
+
+    generation = _generation(server_id)
     pool = await util.get_pool()
-    # Set config:server_id:key.
-    built = "config:{sid}:{key}".format(sid=server_id, key=key)
     async with pool.get() as conn:
-        conn.set(built, value)
+        with metrics.redis_call("get_server_config"):
+            data = await conn.hgetall(_hash_key(server_id))
+        # Old keys may still be lying around if the migration hasn't finished.
+        complete = await _is_migrated()
+    values = {_decode(k): _decode(v) for (k, v) in data.items()}
+    # Writes which haven't been flushed yet win over what redis has.
+    pending = writes.get_buffer().pending_for(server_id)
+    values.update(pending)
+    if _generation(server_id) == generation:
+        for key, value in values.items():
+            _cache_store(server_id, key, value)
+    for key, value in pending.items():
+        if value is None:
+            del values[key]
+    return ServerConfig(server_id, values, complete=complete)
+
+
+async def get_configs(server_id: str, keys, default=None) -> dict:
+    """
+    Gets multiple configs from the redis DB at once.
+
+    Returns a dict of key -> value, with default for keys that do not exist.
+    """
+    values = await _get_raw(server_id, keys, "get_configs")
+    return {key: value if value is not None else default for (key, value) in values.items()}
+
+
+async def get_config(server_id: str, key: str, default=None, type_: type=str) -> str:
+    """
+    Gets a config from the redis DB.
+
+    Values are cached in-process, so a warm read does not touch redis at all.
+    """
+    value = (await _get_raw(server_id, (key,), "get_config"))[key]
+    return _convert(value, default, type_)
+
+async def set_config(server_id: str, key: str, value: str):
+    """
+    Sets a config in the redis DB.
+
+    The write is queued, and flushed with others shortly after. Reads see it straight away.
+    """
+    writes.get_buffer().set(server_id, key, str(value))
+    invalidate(server_id, key)
+    _cache_store(server_id, key, str(value))
+    _run_invalidation_handlers(server_id, key)
 
 
 async def delete_config(server_id: str, key: str):
     """
     Deletes a val in the redis DB.
+
+    Like set_config(), the delete is queued.
     """
-    pool = await util.get_pool()
-    # Set config:server_id:key.
-    built = "config:{sid}:{key}".format(sid=server_id, key=key)
-    async with pool.get() as conn:
-        conn.delete(built)
+    writes.get_buffer().delete(server_id, key)
+    invalidate(server_id, key)
+    _cache_store(server_id, key, None)
+    _run_invalidation_handlers(server_id, key)
+
+
+async def flush():
+    """
+    Waits for every queued config write to reach redis.
+
+    Raises the error if they could not be written.
+    """
+    await writes.get_buffer().flush()
+
+
+async def get_set(key: str) -> set:
+    """
+    Gets the members of a set in the redis DB, as strings.
+
+    Concurrent reads are batched together.
+    """
+    return {_decode(member) for member in await batching.get_batcher().smembers(key, "get_set")}
 
 
 async def get_key(key: str) -> str:
     pool = await util.get_pool()
     async with pool.get() as conn:
+        with metrics.redis_call("get_key"):
+            data = await conn.get(key)
         try:
-            return (await conn.get(key)).decode()
+            return data.decode()
         except AttributeError:
             return None
-
@@ -24,7 +24,7 @@ import shlex
 
 import discord
 
-from navalbot.api import util
+from navalbot.api import outbound, util
 from navalbot.api.util import has_permissions_with_override, _get_overrides, prov_dec_func, get_global_config
 
 
@@ -40,7 +40,8 @@ def with_permission(*role: str):
             try:
                 assert isinstance(message.author, discord.Member)
             except AssertionError:
-                await client.send_message(message.channel, ":no_entry: Cannot determine your role!")
+                await client.send_message(message.channel, ":no_entry: Cannot determine your role!",
+                                          priority=outbound.ERROR)
                 return
 
             # Use has_permissions with override.
@@ -49,7 +50,8 @@ def with_permission(*role: str):
                 await func(client, message)
             else:
                 await client.send_message(message.channel,
-                                          ":no_entry: You do not have any of the required roles: `{}`!".format(role))
+                                          ":no_entry: You do not have any of the required roles: `{}`!".format(role),
+                                          priority=outbound.ERROR)
 
         async def __get_roles(server_id):
             return role.union(await _get_overrides(server_id, func.__name__))
@@ -84,7 +86,8 @@ def enforce_args(count: int, error_msg: str = None):
                 if len(split) < count:
                     await client.send_message(
                         message.channel,
-                        error_msg
+                        error_msg,
+                        priority=outbound.ERROR
                     )
                     return
                 else:
@@ -92,7 +95,8 @@ def enforce_args(count: int, error_msg: str = None):
                     await func(client, message, split)
 
             except ValueError:
-                await client.send_message(message.channel, ":x: You must escape your quotation marks: `\\'`")
+                await client.send_message(message.channel, ":x: You must escape your quotation marks: `\\'`",
+                                          priority=outbound.ERROR)
 
         __fake_enforcing_func = prov_dec_func(func, __fake_enforcing_func)
 
@@ -116,7 +120,8 @@ def owner(func):
             await func(client, message)
         else:
             await client.send_message(message.channel,
-                                      ":no_entry: This command is restricted to bot owners!")
+                                      ":no_entry: This command is restricted to bot owners!",
+                                      priority=outbound.ERROR)
 
     __fake_permission_func = prov_dec_func(func, __fake_permission_func)
 
@@ -0,0 +1,99 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Background message deletion.
+# Deletions are collected per channel for a short window, then sent as one bulk delete, so nothing waits on them and
+# a busy channel costs one request instead of one per message.
+import datetime
+import logging
+
+import discord
+
+from navalbot.api import metrics, util
+
+logger = logging.getLogger("NavalBot")
+
+# Discord only bulk deletes between 2 and 100 messages, younger than 14 days.
+BULK_MIN = 2
+BULK_MAX = 100
+BULK_MAX_AGE = datetime.timedelta(days=13, hours=23)
+
+
+class DeleteBatcher(object):
+    """
+    Deletes messages in the background, in bulk where possible.
+    """
+
+    def __init__(self, client: discord.Client):
+        cfg = util.get_global_config("autodelete", default={}) or {}
+        self.window = float(cfg.get("window", 1.0))
+
+        self.client = client
+        # channel id -> messages waiting to be deleted.
+        self._pending = {}
+
+    def delete(self, message: discord.Message):
+        """
+        Queues a message for deletion. This returns straight away.
+        """
+        channel_id = message.channel.id
+        pending = self._pending.get(channel_id)
+        if pending is None:
+            pending = self._pending[channel_id] = []
+            self.client.loop.call_later(self.window, self._flush, channel_id)
+        pending.append(message)
+
+    def _flush(self, channel_id: str):
+        messages = self._pending.pop(channel_id, [])
+        if messages:
+            self.client.loop.create_task(self._delete(messages))
+
+    async def _delete(self, messages: list):
+        now = datetime.datetime.utcnow()
+        single = [m for m in messages if isinstance(m.channel, discord.PrivateChannel) or
+                  now - m.timestamp > BULK_MAX_AGE]
+        bulk = [m for m in messages if m not in single]
+
+        for i in range(0, len(bulk), BULK_MAX):
+            chunk = bulk[i:i + BULK_MAX]
+            if len(chunk) < BULK_MIN:
+                single.extend(chunk)
+                continue
+            try:
+                await self.client.delete_messages(chunk)
+            except (discord.HTTPException, discord.ClientException):
+                # Most likely missing Manage Messages, which single deletes of our own messages don't need.
+                logger.warning("Bulk delete of {} messages failed, deleting them one by one.".format(len(chunk)))
+                single.extend(chunk)
+                continue
+            metrics.AUTODELETE_REQUESTS.inc("bulk")
+            metrics.AUTODELETE_MESSAGES.inc(amount=len(chunk))
+
+        for message in single:
+            try:
+                await self.client.delete_message(message)
+            except discord.HTTPException:
+                logger.warning("Could not delete message {} in #{}.".format(message.id, message.channel))
+                continue
+            metrics.AUTODELETE_REQUESTS.inc("single")
+            metrics.AUTODELETE_MESSAGES.inc()
@@ -0,0 +1,247 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Hook dispatching.
+# Hooks are ran by a fixed pool of workers, rather than a task each, so a slow or heavy hook can't flood the loop.
+import asyncio
+import logging
+import time
+import traceback
+
+from navalbot.api import util
+
+logger = logging.getLogger("NavalBot")
+
+
+class Hook(object):
+    """
+    A registered hook, and its counters.
+    """
+
+    def __init__(self, func, kind: str, events=None, max_pending: int = None, timeout: float = None):
+        self.func = func
+        self.kind = kind
+        # Picked up from client.hooks, rather than registered with a decorator.
+        self.adopted = False
+        # Gateway event types (the `t` field) this hook wants, or None for every event.
+        self.events = frozenset(events) if events is not None else None
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self.name = "{}.{}".format(func.__module__, func.__name__)
+
+        # Counters.
+        self.pending = 0
+        self.calls = 0
+        self.errors = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.slow = 0
+        self.total_time = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "pending": self.pending,
+            "calls": self.calls,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "timeouts": self.timeouts,
+            "slow": self.slow,
+            "total_time": self.total_time,
+        }
+
+
+class HookDispatcher(object):
+    """
+    Runs hooks on a bounded pool of workers.
+
+    Functions appended to the client's hooks dict by hand, rather than registered with a decorator, are picked up
+    with the default settings the next time their kind is dispatched, and dropped once they are removed from it.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, hooks: dict = None):
+        cfg = util.get_global_config("hooks", default={}) or {}
+        self.loop = loop
+        self.workers = int(cfg.get("workers", 8))
+        self.max_pending = int(cfg.get("max_pending", 100))
+        self.timeout = float(cfg.get("timeout", 30))
+        self.slow_threshold = float(cfg.get("slow", 1.0))
+
+        self.queue = asyncio.Queue(maxsize=int(cfg.get("queue_size", 1000)))
+
+        # The client's kind -> [func] dict.
+        self.client_hooks = hooks if hooks is not None else {}
+        # kind -> (id, length) of its client_hooks list when it was last synced.
+        self._synced = {}
+
+        self.hooks = []
+        # kind -> list of hooks which want every event.
+        self._wildcard = {}
+        # (kind, event type) -> list of hooks.
+        self._by_event = {}
+
+        self._tasks = []
+
+    def start(self):
+        """
+        Starts the workers. This is safe to call more than once.
+        """
+        self._tasks = [t for t in self._tasks if not t.done()]
+        for _ in range(self.workers - len(self._tasks)):
+            self._tasks.append(self.loop.create_task(self._worker()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    # region registration
+    def _rebuild(self):
+        wildcard = {}
+        by_event = {}
+        for hook in self.hooks:
+            if hook.events is None:
+                wildcard.setdefault(hook.kind, []).append(hook)
+            else:
+                for event in hook.events:
+                    by_event.setdefault((hook.kind, event), []).append(hook)
+        # Swap in whole, so dispatching never sees a half-built index.
+        self._wildcard, self._by_event = wildcard, by_event
+
+    def register(self, func, kind: str, events=None, max_pending: int = None, timeout: float = None) -> Hook:
+        hook = Hook(func, kind, events=events,
+                    max_pending=max_pending if max_pending is not None else self.max_pending,
+                    timeout=timeout if timeout is not None else self.timeout)
+        self.hooks.append(hook)
+        self._rebuild()
+        return hook
+
+    def unregister(self, func):
+        self.hooks = [h for h in self.hooks if h.func is not func]
+        self._rebuild()
+
+    def detach(self, hooks: list):
+        """
+        Removes registered hooks, keeping their settings and counters so they can be attached again.
+        """
+        self.hooks = [h for h in self.hooks if h not in hooks]
+        self._rebuild()
+
+    def attach(self, hooks: list):
+        self.hooks.extend(hooks)
+        self._rebuild()
+
+    def _sync(self, kind: str):
+        """
+        Picks up functions appended to client_hooks by hand, and drops those which were removed again.
+        """
+        funcs = self.client_hooks.get(kind)
+        # Cheap enough to check every dispatch. Lists are only ever appended to, removed from or replaced.
+        state = (id(funcs), len(funcs)) if funcs is not None else None
+        if self._synced.get(kind) == state:
+            return
+        self._synced[kind] = state
+
+        funcs = funcs or []
+        present = set(funcs)
+        known = {h.func for h in self.hooks if h.kind == kind}
+        stale = [h for h in self.hooks if h.kind == kind and h.adopted and h.func not in present]
+        if stale:
+            self.detach(stale)
+        for func in funcs:
+            if func in known:
+                continue
+            known.add(func)
+            hook = self.register(func, kind)
+            hook.adopted = True
+            logger.info("Picked up {} hook {}, which was added to client.hooks by hand.".format(kind, hook.name))
+
+    # endregion
+
+    def dispatch(self, kind: str, *args, event: str = None, **kwargs):
+        """
+        Queues every hook of this kind which wants the event.
+
+        Nothing is queued, and no task is created, for events no hook wants.
+        """
+        self._sync(kind)
+        hooks = self._wildcard.get(kind, [])
+        if event is not None:
+            filtered = self._by_event.get((kind, event))
+            if filtered:
+                hooks = hooks + filtered
+        for hook in hooks:
+            self.submit(hook, *args, **kwargs)
+
+    def submit(self, hook: Hook, *args, **kwargs):
+        if hook.pending >= hook.max_pending:
+            self._drop(hook, "too many pending calls")
+            return
+        try:
+            self.queue.put_nowait((hook, args, kwargs, time.monotonic()))
+        except asyncio.QueueFull:
+            self._drop(hook, "the hook queue is full")
+            return
+        hook.pending += 1
+
+    def _drop(self, hook: Hook, reason: str):
+        hook.dropped += 1
+        # Don't spam the log with every single drop.
+        if hook.dropped == 1 or hook.dropped % 100 == 0:
+            logger.warning("Dropped call to hook {} as {} ({} dropped so far).".format(hook.name, reason,
+                                                                                      hook.dropped))
+
+    async def _worker(self):
+        while True:
+            hook, args, kwargs, queued = await self.queue.get()
+            hook.pending -= 1
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(hook.func(*args, **kwargs), hook.timeout)
+            except asyncio.TimeoutError:
+                hook.timeouts += 1
+                logger.warning("Hook {} timed out after {}s.".format(hook.name, hook.timeout))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                hook.errors += 1
+                logger.error("Error in hook {}".format(hook.name))
+                traceback.print_exc()
+            finally:
+                taken = time.monotonic() - start
+                hook.calls += 1
+                hook.total_time += taken
+                if taken > self.slow_threshold:
+                    hook.slow += 1
+                    logger.warning("Hook {} took {:.2f}s (queued for {:.2f}s).".format(hook.name, taken,
+                                                                                      start - queued))
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of every hook, and the queue depth.
+        """
+        return {
+            "queue_depth": self.queue.qsize(),
+            "hooks": {hook.name: hook.stats() for hook in self.hooks},
+        }
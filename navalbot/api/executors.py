@@ -0,0 +1,132 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Managed executors.
+# Blocking work goes to the thread pool. CPU heavy work, which would hold the GIL, goes to the process pool.
+# Both are sized in config.yml, measured, and shut down when the bot logs out.
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent import futures
+
+from navalbot.api import metrics, settings
+
+logger = logging.getLogger("NavalBot")
+
+
+def _timed_call(func, args: tuple):
+    # Runs in the worker, so the wait for a free worker can be measured.
+    # This has to be a module level function, so process pools can pickle it.
+    return time.time(), func(*args)
+
+
+class ManagedExecutor(object):
+    """
+    A thread or process pool, created when first used.
+    """
+
+    def __init__(self, name: str, cls, workers: int = None):
+        self.name = name
+        self.cls = cls
+        self.workers = workers or None
+        self._executor = None
+
+        # Submitted, but not finished.
+        self.in_flight = 0
+
+        metrics.EXECUTOR_IN_FLIGHT.set_function(lambda: self.in_flight, name)
+        metrics.EXECUTOR_WAITING.set_function(self.waiting, name)
+
+    @property
+    def executor(self) -> futures.Executor:
+        if self._executor is None:
+            self._executor = self.cls(max_workers=self.workers)
+            logger.info("Started the {} pool with {} workers.".format(self.name, self._executor._max_workers))
+        return self._executor
+
+    def waiting(self) -> int:
+        """
+        Roughly how many calls are queued for a worker.
+        """
+        if self._executor is None:
+            return 0
+        return max(0, self.in_flight - self._executor._max_workers)
+
+    async def run(self, func, *args):
+        """
+        Runs func(*args) in this pool.
+        """
+        loop = asyncio.get_event_loop()
+        submitted = time.time()
+        self.in_flight += 1
+        try:
+            started, result = await loop.run_in_executor(self.executor, functools.partial(_timed_call, func, args))
+        finally:
+            self.in_flight -= 1
+        finished = time.time()
+        metrics.EXECUTOR_WAIT.observe(max(0.0, started - submitted), self.name)
+        metrics.EXECUTOR_RUN.observe(max(0.0, finished - started), self.name)
+        return result
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the pool. It will be started again if it is used afterwards.
+        """
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=wait)
+            logger.info("Stopped the {} pool.".format(self.name))
+
+
+class LazyExecutor(futures.Executor):
+    """
+    Stands in for a managed pool's executor, wherever an Executor object is needed.
+
+    The pool is looked up on every call, so this starts it on first use, and keeps working after it is shut down.
+    """
+
+    def __init__(self, pool: ManagedExecutor):
+        self.pool = pool
+
+    def submit(self, fn, *args, **kwargs) -> futures.Future:
+        return self.pool.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        self.pool.shutdown(wait=wait)
+
+
+_cfg = settings.load().get("executors", {}) or {}
+
+threads = ManagedExecutor("thread", futures.ThreadPoolExecutor, int(_cfg.get("threads", 0)))
+processes = ManagedExecutor("process", futures.ProcessPoolExecutor,
+                            int(_cfg.get("processes", 0)) or os.cpu_count())
+
+
+def shutdown(wait: bool = True):
+    """
+    Stops every pool.
+    """
+    for pool in (threads, processes):
+        pool.shutdown(wait=wait)
@@ -0,0 +1,158 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Factoid name filters.
+# Most prefixed words which aren't commands aren't factoids either, so misses are rejected locally with a bloom
+# filter of each server's factoid names, instead of costing a redis round trip.
+import asyncio
+import logging
+import time
+
+from navalbot.api import db, metrics, util
+from navalbot.api.bloom import ScalableBloomFilter
+
+logger = logging.getLogger("NavalBot")
+
+_filter = None
+
+
+class FactoidFilter(object):
+    """
+    Per-server bloom filters of factoid names.
+    """
+
+    def __init__(self):
+        cfg = util.get_global_config("factoids", default={}) or {}
+        self.error_rate = float(cfg.get("filter_error_rate", 0.01))
+
+        # server_id -> ScalableBloomFilter
+        self._filters = {}
+        # Until the first build finishes, everything might exist.
+        self.ready = False
+        # Names added while a build is running, which the build may not have seen.
+        self._pending = None
+
+        self.rejected = 0
+
+        db.add_invalidation_handler(self._on_change)
+
+    def might_exist(self, server_id: str, name: str) -> bool:
+        """
+        Checks if a factoid might exist. If this returns False, it definitely does not.
+        """
+        if not self.ready:
+            return True
+        f = self._filters.get(server_id)
+        if f is not None and name in f:
+            return True
+        self.rejected += 1
+        return False
+
+    def add(self, server_id: str, name: str):
+        if self._pending is not None:
+            self._pending.append((server_id, name))
+        f = self._filters.get(server_id)
+        if f is None:
+            f = self._filters[server_id] = ScalableBloomFilter(error_rate=self.error_rate)
+        f.add(name)
+
+    def _on_change(self, server_id: str, key: str):
+        if server_id == "*":
+            # We may have missed writes, so rebuild from scratch.
+            if self.ready:
+                asyncio.get_event_loop().create_task(self.build())
+        elif key is not None and key.startswith("fac:"):
+            # Deleted factoids are left in; that only costs a redis lookup if someone asks for them.
+            self.add(server_id, key[len("fac:"):])
+
+    async def _scan(self) -> dict:
+        """
+        Collects every factoid name, per server, from both storage layouts.
+        """
+        names = {}
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            cursor = 0
+            while True:
+                with metrics.redis_call("scan_factoids"):
+                    cursor, keys = await conn.scan(cursor, match="config:*", count=1000)
+                hashes = []
+                for key in keys:
+                    parts = key.decode().split(":", 2)
+                    if len(parts) == 2:
+                        hashes.append(parts[1])
+                    elif parts[2].startswith("fac:"):
+                        names.setdefault(parts[1], []).append(parts[2][len("fac:"):])
+                if hashes:
+                    pipe = conn.pipeline()
+                    futs = [(sid, pipe.hkeys(db._hash_key(sid))) for sid in hashes]
+                    with metrics.redis_call("scan_factoids"):
+                        await pipe.execute()
+                    for sid, fut in futs:
+                        for field in await fut:
+                            field = field.decode()
+                            if field.startswith("fac:"):
+                                names.setdefault(sid, []).append(field[len("fac:"):])
+                if cursor == 0:
+                    break
+        return names
+
+    async def build(self):
+        """
+        Rebuilds every filter from redis. Lookups aren't filtered until this has finished once.
+        """
+        if self._pending is not None:
+            # Already building.
+            return
+        self._pending = []
+        start = time.monotonic()
+        try:
+            names = await self._scan()
+        except Exception:
+            logger.exception("Failed to build the factoid filter. Factoid misses will not be filtered.")
+            self._pending = None
+            self.ready = False
+            return
+
+        filters = {}
+        for sid, server_names in names.items():
+            f = filters[sid] = ScalableBloomFilter(capacity=max(64, len(server_names) * 2),
+                                                   error_rate=self.error_rate)
+            for name in server_names:
+                f.add(name)
+        pending, self._pending = self._pending, None
+        self._filters = filters
+        for sid, name in pending:
+            self.add(sid, name)
+        self.ready = True
+        logger.info("Built factoid filters for {} servers in {:.2f}s.".format(len(filters), time.monotonic() - start))
+
+
+def get_filter() -> FactoidFilter:
+    """
+    Gets the shared factoid filter.
+    """
+    global _filter
+    if _filter is None:
+        _filter = FactoidFilter()
+    return _filter
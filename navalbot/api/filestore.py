@@ -0,0 +1,234 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Content-addressed storage for factoid attachments.
+# Files are stored once per content hash under files/objects/, with reference counts from factoids, a disk quota
+# with LRU eviction of files no factoid uses, and a small JSON index so serving a file never has to probe the directory.
+# Factoids refer to stored files as `file:<sha256><ext>`. Older factoids refer to flat files in files/ by name, and
+# those are still served from there.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from navalbot import exceptions
+from navalbot.api import util
+
+logger = logging.getLogger("NavalBot")
+
+_store = None
+
+
+class FileStore(object):
+    """
+    A content-addressed attachment store.
+    """
+
+    def __init__(self, root: str = None):
+        cfg = util.get_global_config("files", default={}) or {}
+        self.root = root or os.path.join(os.getcwd(), "files")
+        self.objects = os.path.join(self.root, "objects")
+        self.index_path = os.path.join(self.root, "index.json")
+        self.quota = int(float(cfg.get("quota_mb", 1024)) * 1024 * 1024)
+        self.max_size = int(float(cfg.get("max_file_mb", 8)) * 1024 * 1024)
+
+        # ref -> {"size", "refs", "atime", "name"}
+        self.index = {}
+        # url -> ref, so the same URL is never downloaded twice.
+        self.urls = {}
+
+        self._save_handle = None
+
+    # region index
+    def load(self):
+        """
+        Loads the index. This blocks, and is only used at startup.
+        """
+        os.makedirs(self.objects, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.error("File store index is corrupt, starting with an empty one.")
+            return
+        self.index = data.get("objects", {})
+        self.urls = data.get("urls", {})
+
+    def _write_index(self, data: str):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.index_path)
+
+    def _schedule_save(self):
+        # Coalesce bursts of changes into one write.
+        # Looked up each time, as util.loop is not the running loop under uvloop.
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_event_loop().call_later(1.0, self._save)
+
+    def _save(self):
+        self._save_handle = None
+        data = json.dumps({"objects": self.index, "urls": self.urls})
+        asyncio.get_event_loop().create_task(util.with_threading(lambda: self._write_index(data)))
+
+    # endregion
+
+    @staticmethod
+    def is_ref(name: str) -> bool:
+        """
+        Checks if a `file:` factoid value refers to a stored object, rather than an old flat file.
+        """
+        digest = name.split(".", 1)[0]
+        return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+    def _object_path(self, ref: str) -> str:
+        return os.path.join(self.objects, ref[:2], ref)
+
+    def path_for(self, name: str) -> str:
+        """
+        Gets the path to serve a `file:` factoid from.
+
+        Returns None if it is a stored object which doesn't exist. Old flat files are not checked.
+        """
+        if not self.is_ref(name):
+            return os.path.join(self.root, name)
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        entry["atime"] = time.time()
+        self._schedule_save()
+        return self._object_path(name)
+
+    # region references
+    def incref(self, ref: str):
+        entry = self.index.get(ref)
+        if entry is not None:
+            entry["refs"] += 1
+            self._schedule_save()
+
+    def decref(self, ref: str):
+        """
+        Drops a factoid reference. Unreferenced files are kept until the quota needs the space.
+        """
+        entry = self.index.get(ref)
+        if entry is not None and entry["refs"] > 0:
+            entry["refs"] -= 1
+            self._schedule_save()
+
+    # endregion
+
+    def _write_object(self, ref: str, data: bytes):
+        path = self._object_path(ref)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def _download(self, url: str) -> bytes:
+        import aiohttp
+        with aiohttp.ClientSession() as sess:
+            async with sess.get(url) as get:
+                assert isinstance(get, aiohttp.ClientResponse)
+                length = get.headers.get("content-length")
+                if length is not None and int(length) > self.max_size:
+                    raise exceptions.CommandError(":x: File is too big to download.")
+                data = await get.read()
+        if len(data) > self.max_size:
+            raise exceptions.CommandError(":x: File is too big to download.")
+        return data
+
+    async def store_url(self, url: str) -> str:
+        """
+        Downloads a URL into the store, and returns its ref.
+
+        Nothing is downloaded if this URL has been stored before, and nothing is written if the content is already
+        stored. Raises a CommandError if the file is too big, or the store is full of files factoids still use.
+        """
+        ref = self.urls.get(url)
+        if ref is not None and ref in self.index:
+            return ref
+
+        data = await self._download(url)
+        digest = await util.with_threading(lambda: hashlib.sha256(data).hexdigest())
+        ext = os.path.splitext(util.sanitize(url.split("/")[-1]))[1][:16]
+        ref = digest + ext
+
+        if ref not in self.index:
+            # Make room first, so nothing is written if there is none.
+            await self._enforce_quota(len(data))
+            await util.with_threading(lambda: self._write_object(ref, data))
+            self.index[ref] = {"size": len(data), "refs": 0, "atime": time.time(),
+                               "name": util.sanitize(url.split("/")[-1])}
+            logger.info("Stored {} as {}".format(url, ref))
+        self.urls[url] = ref
+        self._schedule_save()
+        return ref
+
+    async def _enforce_quota(self, extra: int = 0):
+        """
+        Evicts least recently used files which no factoid uses, until `extra` more bytes fit in the quota.
+
+        Files still used by factoids are never evicted. If evicting every unused file wouldn't make enough room,
+        nothing is evicted, and a CommandError is raised.
+        """
+        total = sum(e["size"] for e in self.index.values()) + extra
+        if total <= self.quota:
+            return
+        candidates = sorted((r for r in self.index if not self.index[r]["refs"]),
+                            key=lambda r: self.index[r]["atime"])
+        if total - sum(self.index[r]["size"] for r in candidates) > self.quota:
+            raise exceptions.CommandError(":x: The file store is full.")
+
+        evicted = []
+        for ref in candidates:
+            if total <= self.quota:
+                break
+            total -= self.index.pop(ref)["size"]
+            evicted.append(ref)
+            logger.info("Evicting {} from the file store.".format(ref))
+
+        self.urls = {u: r for (u, r) in self.urls.items() if r in self.index}
+        await util.with_threading(lambda: self._remove_objects(evicted))
+
+    def _remove_objects(self, refs: list):
+        for ref in refs:
+            try:
+                os.remove(self._object_path(ref))
+            except FileNotFoundError:
+                pass
+
+
+def get_store() -> FileStore:
+    """
+    Gets the shared file store, loading its index the first time.
+    """
+    global _store
+    if _store is None:
+        _store = FileStore()
+        _store.load()
+    return _store
@@ -34,37 +34,73 @@ from navalbot.api.botcls import NavalClient
 logger = logging.getLogger("NavalBot")
 
 
-def on_message(func: typing.Callable[[NavalClient, discord.Message], None]) -> types.FunctionType:
-    """
-    Registers a hook to be ran every message.
-    """
+def _get_instance(func, kind: str) -> NavalClient:
     try:
         instance = NavalClient.instance
         assert isinstance(instance, NavalClient)
     except (AssertionError, AttributeError):
-        logger.critical("Attempted to register on_message for function `{}` before bot is created."
-                        .format(func.__name__))
+        logger.critical("Attempted to register {} for function `{}` before bot is created."
+                        .format(kind, func.__name__))
+        return None
+    return instance
+
+
+def _register(func, kind: str, **kwargs):
+    instance = _get_instance(func, kind)
+    if instance is None:
         return
 
-    if 'on_message' not in instance.hooks:
-        instance.hooks["on_message"] = []
+    if kind not in instance.hooks:
+        instance.hooks[kind] = []
+
+    instance.hooks[kind].append(func)
+    instance.dispatcher.register(func, kind, **kwargs)
+
+
+def on_message(func: typing.Callable[[NavalClient, discord.Message], None] = None, *,
+               max_pending: int = None, timeout: float = None) -> types.FunctionType:
+    """
+    Registers a hook to be ran every message.
+
+    This can be used bare, or called with `max_pending` and `timeout` to override the defaults in config.yml.
+    """
+    def __decorator(func):
+        _register(func, "on_message", max_pending=max_pending, timeout=timeout)
+        return func
 
-    instance.hooks["on_message"].append(func)
+    if func is None:
+        return __decorator
+    return __decorator(func)
 
 
-def on_generic_event(func: typing.Callable[[NavalClient, dict], None]) -> types.FunctionType:
+def on_generic_event(func: typing.Callable[[dict], None] = None, *, events: typing.Iterable[str] = None,
+                     max_pending: int = None, timeout: float = None) -> types.FunctionType:
     """
     Registers a hook to be ran on every event.
+
+    Pass `events` to only receive some gateway event types (the `t` field), such as `("MESSAGE_CREATE",)`.
+    Frames of any other type never reach the hook.
     """
-    try:
-        instance = NavalClient.instance
-        assert isinstance(instance, NavalClient)
-    except (AssertionError, AttributeError):
-        logger.critical("Attempted to register on_message for function `{}` before bot is created."
-                        .format(func.__name__))
-        return
+    def __decorator(func):
+        _register(func, "on_recv", events=events, max_pending=max_pending, timeout=timeout)
+        return func
 
-    if 'on_recv' not in instance.hooks:
-        instance.hooks['on_recv'] = []
+    if func is None:
+        return __decorator
+    return __decorator(func)
+
+
+def on_error(func: typing.Callable[..., None] = None, *, max_pending: int = None,
+             timeout: float = None) -> types.FunctionType:
+    """
+    Registers a hook to be ran when an event handler raises.
+
+    It is called with the name of the event method, and the arguments it was called with.
+    """
+    def __decorator(func):
+        _register(func, "on_error", max_pending=max_pending, timeout=timeout)
+        return func
 
-    instance.hooks['on_recv'].append(func)
+    if func is None:
+        return __decorator
+    return __decorator(func)
@@ -0,0 +1,135 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Logging helpers.
+# Records can be handed to a background thread for formatting and writing, and chatty loggers can be sampled or
+# rate limited, so that console I/O never stalls the event loop.
+import atexit
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Logger for the per-message lines. This is the one you usually want to sample.
+MESSAGE_LOGGER = "NavalBot.messages"
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    A QueueHandler which leaves all formatting to the listener thread.
+
+    The stock handler formats the message before queueing it, which is the expensive bit we want off the loop.
+    The queue is in-process, so the record doesn't need to be made picklable.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class ThrottleFilter(logging.Filter):
+    """
+    Samples and rate limits records below WARNING, per logger.
+
+    Rules apply to the named logger and all of its children.
+    """
+
+    def __init__(self, rate_limits: dict = None, samples: dict = None):
+        super().__init__()
+        # logger name -> records per second
+        self.rate_limits = {k: float(v) for (k, v) in (rate_limits or {}).items()}
+        # logger name -> fraction of records kept
+        self.samples = {k: float(v) for (k, v) in (samples or {}).items()}
+
+        # logger name -> (rate limit rule, sample rule), resolved once per name.
+        self._rules = {}
+        # rule name -> [tokens, last refill]
+        self._buckets = {}
+
+        self.suppressed = 0
+
+    def _resolve(self, rules: dict, name: str):
+        while name:
+            if name in rules:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def _allow_rate(self, rule: str) -> bool:
+        rate = self.rate_limits[rule]
+        now = time.monotonic()
+        bucket = self._buckets.get(rule)
+        if bucket is None:
+            bucket = self._buckets[rule] = [rate, now]
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rules = self._rules.get(record.name)
+        if rules is None:
+            rules = self._rules[record.name] = (self._resolve(self.rate_limits, record.name),
+                                                self._resolve(self.samples, record.name))
+        rate_rule, sample_rule = rules
+
+        if sample_rule is not None and random.random() >= self.samples[sample_rule]:
+            self.suppressed += 1
+            return False
+        if rate_rule is not None and not self._allow_rate(rate_rule):
+            self.suppressed += 1
+            return False
+        return True
+
+
+def install(root: logging.Logger, handler: logging.Handler, cfg: dict) -> logging.Handler:
+    """
+    Makes a handler the only handler of the root logger, as configured in the `logging` section of config.yml.
+
+    Returns the handler that was actually attached to the root logger.
+    """
+    # Anything else on root would be written to synchronously, and without the filter.
+    for old in list(root.handlers):
+        root.removeHandler(old)
+
+    if cfg.get("queue", True):
+        listener = QueueListener(queue.Queue(-1), handler, respect_handler_level=True)
+        front = LazyQueueHandler(listener.queue)
+        listener.start()
+        # Flush anything left in the queue on exit.
+        atexit.register(listener.stop)
+    else:
+        front = handler
+
+    # Logger filters only see records logged to that exact logger, not its children, so the filter goes on the one
+    # handler every record reaches. It runs before the record is queued.
+    if cfg.get("rate_limits") or cfg.get("sample"):
+        front.addFilter(ThrottleFilter(cfg.get("rate_limits"), cfg.get("sample")))
+
+    root.addHandler(front)
+    return front
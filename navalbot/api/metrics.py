@@ -0,0 +1,301 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Runtime metrics.
+# These are kept in-process, and can be exposed in the Prometheus text format on a small local HTTP endpoint.
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger("NavalBot")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    labels = ['{}="{}"'.format(n, _escape(v)) for (n, v) in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+class Metric(object):
+    """
+    The base metric class.
+    """
+    type_ = "untyped"
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labelvalues: tuple) -> tuple:
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("Metric {} takes labels {}".format(self.name, self.labelnames))
+        return labelvalues
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.doc), "# TYPE {} {}".format(self.name, self.type_)]
+        for labels, value in sorted(self._values.items()):
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def inc(self, *labelvalues, amount: float = 1):
+        key = self._key(labelvalues)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_ = "gauge"
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        super().__init__(name, doc, labelnames)
+        # labels -> callable, for gauges read when rendered.
+        self._callbacks = {}
+
+    def set(self, value: float, *labelvalues):
+        self._values[self._key(labelvalues)] = value
+
+    def set_function(self, func, *labelvalues):
+        """
+        Reads the gauge from func() every time metrics are rendered.
+        """
+        self._callbacks[self._key(labelvalues)] = func
+
+    def render(self) -> list:
+        for labels, func in self._callbacks.items():
+            try:
+                self._values[labels] = func()
+            except Exception:
+                logger.exception("Failed to read gauge {}".format(self.name))
+        return super().render()
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues):
+        key = self._key(labelvalues)
+        data = self._values.get(key)
+        if data is None:
+            # Per-bucket counts (the last one is +Inf), then the sum.
+            data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def count(self, *labelvalues) -> int:
+        data = self._values.get(labelvalues)
+        return sum(data[0]) if data else 0
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.doc), "# TYPE {} {}".format(self.name, self.type_)]
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, labels, 'le="{}"'.format(bound)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labelnames, labels), total))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+@contextlib.contextmanager
+def timer(histogram: Histogram, *labelvalues):
+    """
+    Observes how long the with block took. This works around awaits, too.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, *labelvalues)
+
+
+@contextlib.contextmanager
+def redis_call(function: str):
+    """
+    Counts and times one redis round trip made by a db function.
+    """
+    REDIS_CALLS.inc(function)
+    with timer(REDIS_LATENCY, function):
+        yield
+
+
+def render() -> str:
+    """
+    Renders every metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# region metrics
+MESSAGES = Counter("navalbot_messages_total", "Messages received.")
+MESSAGES_STOPPED = Counter("navalbot_messages_stopped_total", "Messages stopped by a pipeline stage.", ("stage",))
+COMMAND_CALLS = Counter("navalbot_command_invocations_total", "Command invocations.", ("command",))
+COMMAND_ERRORS = Counter("navalbot_command_errors_total", "Commands which raised an exception.", ("command",))
+COMMAND_LATENCY = Histogram("navalbot_command_seconds", "Time taken to run a command.", ("command",))
+REDIS_CALLS = Counter("navalbot_redis_calls_total", "Redis round trips, by db function.", ("function",))
+REDIS_LATENCY = Histogram("navalbot_redis_seconds", "Redis round trip latency, by db function.", ("function",))
+REDIS_BATCHED_READS = Counter("navalbot_redis_batched_reads_total", "Distinct keys read through the read batcher.")
+REDIS_READS = Counter("navalbot_redis_reads_total", "Reads made through the read batcher, by db function.",
+                      ("function",))
+HOOK_QUEUE_DEPTH = Gauge("navalbot_hook_queue_depth", "Hook calls waiting for a worker.")
+LOOP_LAG = Gauge("navalbot_loop_lag_seconds", "How late the last loop lag probe woke up.")
+LOOP_LAG_HISTOGRAM = Histogram("navalbot_loop_lag_observed_seconds", "Loop lag probe results.")
+LOOP_STALLS = Counter("navalbot_loop_stalls_total", "Times the loop was blocked past the watchdog threshold.",
+                      ("owner",))
+OUTBOUND_QUEUE_DEPTH = Gauge("navalbot_outbound_queue_depth", "Messages waiting to be sent.")
+OUTBOUND_SENT = Counter("navalbot_outbound_sent_total", "Messages sent through the outbound scheduler.")
+OUTBOUND_COALESCED = Counter("navalbot_outbound_coalesced_total", "Replies merged into another message.")
+OUTBOUND_DROPPED = Counter("navalbot_outbound_dropped_total",
+                           "Messages dropped because a channel had too many waiting.")
+OUTBOUND_RATE_LIMITED = Counter("navalbot_outbound_rate_limited_total", "Sends which hit a rate limit anyway.")
+AUTODELETE_REQUESTS = Counter("navalbot_autodelete_requests_total", "Autodelete requests, bulk or single.", ("kind",))
+AUTODELETE_MESSAGES = Counter("navalbot_autodelete_messages_total", "Messages deleted by autodelete.")
+EXECUTOR_IN_FLIGHT = Gauge("navalbot_executor_in_flight", "Calls submitted to a pool which haven't finished.",
+                           ("pool",))
+EXECUTOR_WAITING = Gauge("navalbot_executor_waiting", "Calls queued for a free worker, roughly.", ("pool",))
+EXECUTOR_WAIT = Histogram("navalbot_executor_wait_seconds", "Time calls waited for a free worker.", ("pool",))
+EXECUTOR_RUN = Histogram("navalbot_executor_run_seconds", "Time calls took in a worker.", ("pool",))
+STARTUP_SECONDS = Gauge("navalbot_startup_seconds", "Time taken by each step of starting up.", ("phase",))
+ATTACHMENTS_SERVED = Counter("navalbot_attachments_served_total",
+                             "Factoid attachments sent, by where they were read from.", ("source",))
+SCHEDULER_QUEUE_DEPTH = Gauge("navalbot_scheduler_queue_depth", "Commands waiting for a slot.")
+SCHEDULER_RUNNING = Gauge("navalbot_scheduler_running", "Commands holding a slot.")
+SCHEDULER_WAIT = Histogram("navalbot_scheduler_wait_seconds", "Time commands waited for a slot.", ("lane",))
+SCHEDULER_REJECTED = Counter("navalbot_scheduler_rejected_total",
+                             "Commands refused because their server had too many waiting.")
+CONFIG_WRITES_PENDING = Gauge("navalbot_config_writes_pending", "Config writes which haven't been flushed yet.")
+CONFIG_WRITES_FLUSHED = Counter("navalbot_config_writes_flushed_total", "Config writes flushed to redis.")
+CONFIG_WRITES_COALESCED = Counter("navalbot_config_writes_coalesced_total",
+                                  "Config writes replaced by a newer write before being flushed.")
+CONFIG_WRITE_ERRORS = Counter("navalbot_config_write_errors_total", "Config write flushes which failed.")
+# endregion
+
+
+async def measure_loop_lag(interval: float = 1.0):
+    """
+    Measures how late the loop wakes a sleeping task, which is how long callbacks are blocking it for.
+    """
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - start - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_HISTOGRAM.observe(lag)
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        # Skip the headers.
+        while True:
+            line = await reader.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n"
+                     .format(status, len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+_started = False
+_lag_task = None
+_server = None
+
+
+async def start(loop: asyncio.AbstractEventLoop, cfg: dict):
+    """
+    Starts the loop lag probe, and the HTTP endpoint if enabled. This is safe to call more than once.
+
+    If the endpoint can't be bound, that is logged, and the next call tries again.
+    """
+    global _started, _lag_task, _server
+    if _started:
+        return
+
+    if _lag_task is None:
+        _lag_task = loop.create_task(measure_loop_lag(float(cfg.get("lag_interval", 1.0))))
+
+    if cfg.get("enabled", False):
+        host, port = cfg.get("host", "127.0.0.1"), int(cfg.get("port", 9091))
+        try:
+            _server = await asyncio.start_server(_handle_http, host, port)
+        except OSError as e:
+            logger.error("Could not serve metrics on {}:{}: {}".format(host, port, e))
+            return
+        logger.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+
+    _started = True
+
+
+async def stop():
+    """
+    Stops the HTTP endpoint and the loop lag probe.
+    """
+    global _started, _lag_task, _server
+    _started = False
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+    if _server is not None:
+        server, _server = _server, None
+        server.close()
+        await server.wait_closed()
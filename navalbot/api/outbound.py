@@ -0,0 +1,220 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Outbound messages.
+# Messages are queued per channel, and sent as fast as that channel's rate limit allows. Command results go before
+# other messages, which go before error chatter, and short replies waiting for the same channel can be merged into
+# one message.
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+import discord
+
+from navalbot.api import metrics, util
+from navalbot.api.cache import LRUCache, MISSING
+
+logger = logging.getLogger("NavalBot")
+
+# Priorities. Lower is sent first.
+RESULT = 0
+NORMAL = 1
+ERROR = 2
+
+# Discord's maximum message length.
+MAX_LENGTH = 2000
+
+
+class MessageDropped(discord.ClientException):
+    """
+    Raised from send_message when a message was dropped, because its channel had too many waiting.
+    """
+
+
+class Bucket(object):
+    """
+    A token bucket for one rate limited route.
+    """
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+    def block(self, seconds: float):
+        """
+        Stops the route for a while, after the API said we were rate limited anyway.
+        """
+        self.tokens = 0
+        self.blocked_until = time.monotonic() + seconds
+
+
+class _Item(object):
+    __slots__ = ("destination", "content", "kwargs", "coalesce", "future")
+
+    def __init__(self, destination, content: str, kwargs: dict, coalesce: bool, loop: asyncio.AbstractEventLoop):
+        self.destination = destination
+        self.content = content
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.future = loop.create_future()
+
+
+class OutboundDispatcher(object):
+    """
+    Schedules outgoing messages for a client.
+    """
+
+    def __init__(self, client: discord.Client, sender):
+        cfg = util.get_global_config("outbound", default={}) or {}
+        self.enabled = bool(cfg.get("enabled", True))
+        self.rate = int(cfg.get("rate", 5))
+        self.per = float(cfg.get("per", 5.0))
+        self.max_pending = int(cfg.get("max_pending", 50))
+        self.coalesce_length = int(cfg.get("coalesce_length", 400))
+
+        self.client = client
+        # The real send_message.
+        self._sender = sender
+
+        # route -> heap of (priority, seq, item), for routes with messages waiting.
+        self._queues = {}
+        # route -> Bucket. Kept after a route goes idle, so its rate limit is remembered.
+        self._buckets = LRUCache(maxsize=int(cfg.get("max_buckets", 10000)))
+        self._seq = itertools.count()
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _bucket(self, route: str) -> Bucket:
+        bucket = self._buckets.get(route)
+        if bucket is MISSING:
+            bucket = Bucket(self.rate, self.per)
+            self._buckets.put(route, bucket)
+        return bucket
+
+    def send(self, destination, content: str, priority: int = NORMAL, coalesce: bool = False,
+             **kwargs) -> asyncio.Future:
+        """
+        Queues a message. The returned future gives the sent message, or raises MessageDropped if it was dropped.
+
+        Only messages with coalesce=True may be merged with others, and they then share the same message.
+        """
+        route = getattr(destination, "id", destination)
+        item = _Item(destination, content, kwargs,
+                     coalesce and not kwargs and content is not None and len(content) <= self.coalesce_length,
+                     self.client.loop)
+        queue = self._queues.get(route)
+        if queue is None:
+            queue = self._queues[route] = []
+            # The client's loop, which is not util.loop under uvloop.
+            self.client.loop.create_task(self._drain(route))
+
+        heapq.heappush(queue, (priority, next(self._seq), item))
+        if len(queue) > self.max_pending:
+            # Drop the least important message, newest first.
+            worst = max(queue, key=lambda entry: (entry[0], entry[1]))
+            queue.remove(worst)
+            heapq.heapify(queue)
+            worst[2].future.set_exception(MessageDropped("Too many messages waiting for channel {}".format(route)))
+            metrics.OUTBOUND_DROPPED.inc()
+            logger.warning("Too many messages waiting for channel {}, dropped one.".format(route))
+        return item.future
+
+    def _take(self, queue: list) -> list:
+        """
+        Takes the next message off a queue, and any others which can be merged into it.
+        """
+        batch = [heapq.heappop(queue)[2]]
+        if not batch[0].coalesce:
+            return batch
+        length = len(batch[0].content)
+        while queue and queue[0][2].coalesce and length + 1 + len(queue[0][2].content) <= MAX_LENGTH:
+            item = heapq.heappop(queue)[2]
+            length += 1 + len(item.content)
+            batch.append(item)
+        return batch
+
+    async def _drain(self, route: str):
+        queue = self._queues[route]
+        bucket = self._bucket(route)
+        batch = []
+        try:
+            while queue:
+                await bucket.acquire()
+                batch = self._take(queue)
+                first = batch[0]
+                if len(batch) > 1:
+                    metrics.OUTBOUND_COALESCED.inc(amount=len(batch) - 1)
+                content = "\n".join(item.content for item in batch)
+                try:
+                    sent = await self._send(bucket, first.destination, content, first.kwargs)
+                except Exception as e:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                    continue
+                metrics.OUTBOUND_SENT.inc()
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_result(sent)
+        finally:
+            # Nothing can be queued between the loop ending and this, so no message is left behind.
+            del self._queues[route]
+            # Unless the drain was cancelled, in which case nothing waiting will ever be sent.
+            for item in batch + [entry[2] for entry in queue]:
+                if not item.future.done():
+                    item.future.cancel()
+
+    async def _send(self, bucket: Bucket, destination, content: str, kwargs: dict):
+        try:
+            return await self._sender(destination, content, **kwargs)
+        except discord.HTTPException as e:
+            if getattr(e.response, "status", None) != 429:
+                raise
+            # Our bucket was out of step with Discord's. Wait it out, and try once more.
+            metrics.OUTBOUND_RATE_LIMITED.inc()
+            retry_after = float(e.response.headers.get("Retry-After", 1000)) / 1000
+            bucket.block(retry_after)
+            await bucket.acquire()
+            return await self._sender(destination, content, **kwargs)
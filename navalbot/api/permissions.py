@@ -0,0 +1,149 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Cached permission resolution.
+# Role overrides are cached per (server, command), and member role names are indexed as they change.
+import time
+
+import discord
+
+from navalbot.api import db, util
+from navalbot.api.cache import LRUCache, MISSING
+
+_resolver = None
+
+
+def _override_key(server_id: str, cmd_name: str) -> str:
+    return "override:{}:{}".format(server_id, cmd_name)
+
+
+class PermissionResolver(object):
+    """
+    Resolves role permissions without touching redis or rebuilding role sets on every call.
+    """
+
+    def __init__(self):
+        cfg = util.get_global_config("cache", default={}) or {}
+        # (server_id, cmd_name) -> (frozenset of role names, expiry)
+        self._overrides = LRUCache(maxsize=int(cfg.get("max_overrides", 4096)))
+        # Overrides are written to redis directly, so changes are picked up once this expires, or on an invalidation.
+        self._override_ttl = float(cfg.get("override_ttl", 300))
+        # (server_id, member_id) -> frozenset of role names
+        self._members = LRUCache(maxsize=int(cfg.get("max_members", 50000)))
+
+        db.add_invalidation_handler(self._on_invalidation)
+
+    # region overrides
+    async def get_overrides(self, server_id: str, cmd_name: str) -> frozenset:
+        """
+        Gets the role overrides for a command.
+        """
+        key = (server_id, cmd_name)
+        cached = self._overrides.get(key)
+        if cached is not MISSING and cached[1] > time.monotonic():
+            return cached[0]
+
+        overrides = frozenset(await db.get_set(_override_key(server_id, cmd_name)))
+        self._overrides.put(key, (overrides, time.monotonic() + self._override_ttl))
+        return overrides
+
+    def invalidate_overrides(self, server_id: str, cmd_name: str = None):
+        """
+        Drops cached overrides for a command, or for every command on a server if no name is given.
+        """
+        if cmd_name is not None:
+            self._overrides.pop((server_id, cmd_name))
+            return
+        for key in self._overrides.keys():
+            if key[0] == server_id:
+                self._overrides.pop(key)
+
+    def _on_invalidation(self, server_id: str, key: str):
+        if server_id == "*":
+            self._overrides.clear()
+        elif key is None:
+            self.invalidate_overrides(server_id)
+        elif key.startswith("override:"):
+            self.invalidate_overrides(server_id, key[len("override:"):])
+
+    # endregion
+
+    # region members
+    def member_roles(self, member: discord.Member) -> frozenset:
+        """
+        Gets the role names of a member.
+        """
+        key = (member.server.id, member.id)
+        roles = self._members.get(key)
+        if roles is MISSING:
+            roles = frozenset(r.name for r in member.roles)
+            self._members.put(key, roles)
+        return roles
+
+    def update_member(self, member: discord.Member):
+        """
+        Updates the index for a member whose roles may have changed.
+        """
+        key = (member.server.id, member.id)
+        # Only members we've already seen are updated, so presence spam doesn't fill the index.
+        if key in self._members:
+            self._members.put(key, frozenset(r.name for r in member.roles))
+
+    def remove_member(self, member: discord.Member):
+        self._members.pop((member.server.id, member.id))
+
+    def clear_members(self):
+        """
+        Drops every indexed member, after a (re)connect may have missed their updates.
+        """
+        self._members.clear()
+
+    def invalidate_server(self, server_id: str):
+        """
+        Drops every indexed member of a server. Used when roles are renamed or deleted.
+        """
+        for key in self._members.keys():
+            if key[0] == server_id:
+                self._members.pop(key)
+
+    # endregion
+
+    async def has_permissions(self, member: discord.Member, roles: set, server_id: str, cmd_name: str) -> bool:
+        """
+        Checks if a member has any of the roles, or any of the overridden roles for the command.
+        """
+        member_roles = self.member_roles(member)
+        if not member_roles.isdisjoint(roles):
+            return True
+        return not member_roles.isdisjoint(await self.get_overrides(server_id, cmd_name))
+
+
+def get_resolver() -> PermissionResolver:
+    """
+    Gets the shared permission resolver.
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = PermissionResolver()
+    return _resolver
+
@@ -0,0 +1,163 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# The message pipeline.
+# Every message goes through a list of stages, ordered by how much they cost, so that cheap in-memory checks throw
+# out plain chat before anything touches redis or the disk. A stage stops the message by raising StopProcessing.
+import inspect
+import logging
+
+from navalbot import exceptions
+from navalbot.api import db, metrics
+
+logger = logging.getLogger("NavalBot")
+
+# Cost classes. Stages run in this order.
+# Only in-process work: no awaits on I/O.
+MEMORY = 0
+# Redis or disk.
+IO = 1
+# Running the command itself.
+COMMAND = 2
+
+_index = None
+
+
+class MessageContext(object):
+    """
+    What stages have worked out about a message so far.
+    """
+    __slots__ = ("config", "prefix", "extra")
+
+    def __init__(self):
+        # The server config snapshot, once loaded.
+        self.config = None
+        self.prefix = None
+        # For plugin stages to pass things along.
+        self.extra = {}
+
+
+class Stage(object):
+    """
+    A registered stage.
+    """
+    __slots__ = ("func", "cost", "name", "is_async")
+
+    def __init__(self, func, cost: int, name: str = None):
+        self.func = func
+        self.cost = cost
+        self.name = name or func.__name__
+        self.is_async = inspect.iscoroutinefunction(func)
+
+
+class MessagePipeline(object):
+    """
+    Runs messages through the stages.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, func, cost: int = IO, name: str = None) -> Stage:
+        """
+        Adds a stage. It runs after every stage of a lower cost, and after stages of the same cost added before it.
+
+        Stages are called with (client, message, context), and can be coroutines or plain functions.
+        """
+        stage = Stage(func, cost, name)
+        self.attach([stage])
+        return stage
+
+    def remove(self, func):
+        self.stages = [s for s in self.stages if s.func is not func]
+
+    def detach(self, stages: list):
+        self.stages = [s for s in self.stages if s not in stages]
+
+    def attach(self, stages: list):
+        # Sorting is stable, so stages of the same cost keep the order they were added in.
+        self.stages = sorted(self.stages + list(stages), key=lambda s: s.cost)
+
+    async def run(self, client, message):
+        """
+        Runs a message through every stage, until one stops it.
+        """
+        context = MessageContext()
+        stage = None
+        try:
+            for stage in self.stages:
+                if stage.is_async:
+                    await stage.func(client, message, context)
+                else:
+                    stage.func(client, message, context)
+        except exceptions.StopProcessing:
+            metrics.MESSAGES_STOPPED.inc(stage.name)
+
+
+class PrefixIndex(object):
+    """
+    The command prefix of every server seen, so messages without it can be thrown out without loading the config.
+    """
+
+    def __init__(self):
+        # server id -> prefix
+        self._prefixes = {}
+        # Bumped on every change, so a prefix read from before a change isn't learned after it.
+        self.changes = 0
+
+        db.add_invalidation_handler(self._on_change)
+
+    def might_be_command(self, server_id: str, content: str) -> bool:
+        """
+        Checks if a message could be a command. Servers whose prefix isn't known yet always could.
+        """
+        prefix = self._prefixes.get(server_id)
+        return prefix is None or content.startswith(prefix)
+
+    def learn(self, server_id: str, prefix: str, changes: int):
+        """
+        Remembers a server's prefix, read when self.changes was `changes`.
+        """
+        if changes == self.changes:
+            self._prefixes[server_id] = prefix
+
+    def forget(self, server_id: str):
+        self.changes += 1
+        self._prefixes.pop(server_id, None)
+
+    def _on_change(self, server_id: str, key: str):
+        if server_id == "*":
+            self.changes += 1
+            self._prefixes.clear()
+        elif key is None or key == "command_prefix":
+            self.forget(server_id)
+
+
+def get_index() -> PrefixIndex:
+    """
+    Gets the shared prefix index.
+    """
+    global _index
+    if _index is None:
+        _index = PrefixIndex()
+    return _index
@@ -0,0 +1,386 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Plugin loading.
+# Plugins are loaded once per process. What each plugin provides is recorded in plugins/.manifest.json, so that in
+# lazy mode, plugins which only provide commands are not imported until one of their commands is used.
+# Single plugins can be reloaded or unloaded in place, without reconnecting.
+import asyncio
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+
+import discord
+
+from navalbot.api import outbound, util
+from navalbot.api.commands import commands, Command
+
+logger = logging.getLogger("NavalBot")
+
+MANIFEST_VERSION = 2
+
+
+def _module_of(func) -> str:
+    if isinstance(func, LazyCommand):
+        return None
+    if isinstance(func, Command):
+        func = func._wrapped_coro
+    if func is None:
+        return None
+    # util.prov_dec_func wrappers point at the original function with .func, not __wrapped__.
+    func = inspect.unwrap(getattr(func, "func", func))
+    return getattr(func, "__module__", None)
+
+
+def _belongs_to(func, import_name: str) -> bool:
+    module = _module_of(func)
+    return module is not None and (module == import_name or module.startswith(import_name + "."))
+
+
+def _owns(func, import_name: str) -> bool:
+    if isinstance(func, LazyCommand):
+        return func.plugin == import_name
+    return _belongs_to(func, import_name)
+
+
+class LazyCommand(Command):
+    """
+    Stands in for a command whose plugin hasn't been imported yet.
+
+    Invoking it loads the plugin, which replaces it with the real command, and then runs that.
+    """
+
+    def __init__(self, loader: 'PluginLoader', plugin: str, name: str, doc: str = None):
+        # There is nothing to wrap yet, so none of the usual setup applies.
+        self.names = (name,)
+        self.name = name
+        self._wrapped_coro = None
+        self._wants_config = False
+        self._only_owner = False
+        self._concurrency = None
+
+        self.loader = loader
+        self.plugin = plugin
+        self._doc = doc
+
+    def help(self):
+        return self._doc
+
+    async def invoke(self, client: discord.Client, message: discord.Message, config=None):
+        try:
+            await self.loader.load(self.plugin)
+        except Exception:
+            # Already logged by the loader.
+            pass
+        real = commands.get(self.name)
+        if real is None or real is self:
+            await client.send_message(message.channel, ":x: This command is not available right now.",
+                                      priority=outbound.ERROR)
+            return
+        if isinstance(real, Command):
+            return await real.invoke(client, message, config=config)
+        return await real(client, message)
+
+
+class PluginLoader(object):
+    """
+    Loads plugins from plugins/.
+    """
+
+    def __init__(self, client: discord.Client, path: str = "plugins"):
+        cfg = util.get_global_config("plugins", default={}) or {}
+        self.lazy = bool(cfg.get("lazy", False))
+
+        self.client = client
+        self.path = path
+        self.manifest_path = os.path.join(path, ".manifest.json")
+
+        self.loaded = False
+        # import name -> manifest entry
+        self.manifest = {}
+        # import name -> future, for loads in progress or done.
+        self._loads = {}
+        # Only one reload or unload at a time.
+        self._lock = asyncio.Lock()
+
+    # region discovery
+    def discover(self) -> dict:
+        """
+        Finds plugins, as import name -> modification time.
+        """
+        found = {}
+        for entry in os.scandir(self.path):
+            if entry.name == "__pycache__" or entry.name == "__init__.py":
+                continue
+            if entry.name.endswith(".py"):
+                name = entry.name.split(".")[0]
+                mtime = entry.stat().st_mtime
+            elif entry.is_dir():
+                name = entry.name
+                mtime = max((os.stat(os.path.join(root, f)).st_mtime
+                             for (root, dirs, files) in os.walk(entry.path, followlinks=True)
+                             for f in files if f.endswith(".py")), default=0)
+            else:
+                continue
+            found["plugins." + name] = mtime
+        return found
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Plugin manifest is corrupt, rebuilding it.")
+            return {}
+        if data.get("version") != MANIFEST_VERSION:
+            return {}
+        return data.get("plugins", {})
+
+    def _write_manifest(self):
+        data = json.dumps({"version": MANIFEST_VERSION, "plugins": self.manifest}, indent=2, sort_keys=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.manifest_path)
+
+    # endregion
+
+    def _describe(self, import_name: str, mod, mtime: float) -> dict:
+        """
+        Builds the manifest entry for an imported plugin.
+        """
+        provided = {name: (func.help() if isinstance(func, Command) else func.__doc__)
+                    for (name, func) in commands.items() if _belongs_to(func, import_name)}
+        hooks = sorted({kind for (kind, funcs) in self.client.hooks.items()
+                        for func in funcs if _belongs_to(func, import_name)})
+        stages = [stage.name for stage in self.client.pipeline.stages if _belongs_to(stage.func, import_name)]
+        return {
+            "mtime": mtime,
+            "commands": provided,
+            "hooks": hooks,
+            "stages": stages,
+            # Hooks and stages have to be registered to ever run, so only command-only plugins can wait.
+            # A plugin can also opt out with `LAZY = False`.
+            "lazy": bool(provided) and not hooks and not stages and getattr(mod, "LAZY", True),
+        }
+
+    def _import(self, import_name: str):
+        return importlib.import_module(import_name)
+
+    async def _setup(self, import_name: str, mod):
+        if hasattr(mod, "load_plugin"):
+            await mod.load_plugin(self.client)
+        # Only now has the plugin registered everything, including what load_plugin adds.
+        self.manifest[import_name] = self._describe(import_name, mod, self.manifest.get(import_name, {})
+                                                    .get("mtime", 0))
+        self.client.modules[mod.__name__] = mod
+        logger.info("Loaded plugin {} (from {})".format(mod.__name__, mod.__file__))
+
+    async def _load(self, import_name: str):
+        try:
+            mod = self._import(import_name)
+            await self._setup(import_name, mod)
+        except Exception:
+            logger.exception("Error upon loading plugin `{}`.".format(import_name))
+            raise
+
+    async def _teardown(self, mod):
+        if mod is not None and hasattr(mod, "unload_plugin"):
+            try:
+                await mod.unload_plugin(self.client)
+            except Exception:
+                logger.exception("Error in unload_plugin of `{}`.".format(mod.__name__))
+
+    def load(self, import_name: str) -> asyncio.Future:
+        """
+        Loads a plugin, once. Concurrent calls share the same load.
+        """
+        fut = self._loads.get(import_name)
+        if fut is None:
+            fut = self._loads[import_name] = asyncio.ensure_future(self._load(import_name))
+        return asyncio.shield(fut)
+
+    async def load_all(self):
+        """
+        Loads every plugin. This only does anything the first time it is called.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        start = time.monotonic()
+
+        if not os.path.exists(self.path):
+            logger.critical("No plugins directory exists. Your bot is effectively useless.")
+            return
+
+        found = self.discover()
+        cached = self._read_manifest()
+        self.manifest = {name: cached[name] for name in found if name in cached}
+
+        eager, lazy = [], []
+        for import_name, mtime in sorted(found.items()):
+            entry = self.manifest.get(import_name)
+            if self.lazy and entry is not None and entry["mtime"] == mtime and entry["lazy"]:
+                lazy.append(import_name)
+            else:
+                eager.append(import_name)
+                self.manifest[import_name] = {"mtime": mtime}
+
+        for import_name in lazy:
+            for (name, doc) in self.manifest[import_name]["commands"].items():
+                if name not in commands:
+                    commands[name] = LazyCommand(self, import_name, name, doc)
+
+        # Importing has to happen one at a time, but load_plugin coroutines can all run at once.
+        # One plugin failing doesn't stop the others.
+        results = await asyncio.gather(*[self.load(name) for name in eager], return_exceptions=True)
+        failed = [name for (name, result) in zip(eager, results) if isinstance(result, Exception)]
+        for name in failed:
+            # Don't trust a manifest entry for a plugin that didn't load.
+            self.manifest.pop(name, None)
+
+        try:
+            await util.with_threading(self._write_manifest)
+        except OSError:
+            logger.warning("Could not write the plugin manifest.")
+
+        logger.info("Loaded {} plugins ({} deferred, {} failed) in {:.2f}s.".format(
+            len(eager) - len(failed), len(lazy), len(failed), time.monotonic() - start))
+
+    # region registry
+    def resolve(self, name: str) -> str:
+        """
+        Gets the import name of a plugin, from either `name` or `plugins.name`.
+
+        Raises KeyError if there is no such plugin.
+        """
+        import_name = name if name.startswith("plugins.") else "plugins." + name
+        if import_name not in self.client.modules and import_name not in self.discover():
+            raise KeyError(name)
+        return import_name
+
+    def owned(self, import_name: str) -> dict:
+        """
+        Gets everything a plugin has registered: its commands, hooks, message stages, and modules.
+        """
+        return {
+            "commands": {name: func for (name, func) in commands.items() if _owns(func, import_name)},
+            "hooks": {kind: [func for func in funcs if _belongs_to(func, import_name)]
+                      for (kind, funcs) in self.client.hooks.items()},
+            "dispatch": [hook for hook in self.client.dispatcher.hooks if _belongs_to(hook.func, import_name)],
+            "stages": [stage for stage in self.client.pipeline.stages if _belongs_to(stage.func, import_name)],
+            "modules": {name: mod for (name, mod) in sys.modules.items()
+                        if name == import_name or name.startswith(import_name + ".")},
+        }
+
+    def _detach(self, owned: dict):
+        for (name, func) in owned["commands"].items():
+            if commands.get(name) is func:
+                del commands[name]
+        for (kind, funcs) in owned["hooks"].items():
+            self.client.hooks[kind] = [func for func in self.client.hooks.get(kind, []) if func not in funcs]
+        self.client.dispatcher.detach(owned["dispatch"])
+        self.client.pipeline.detach(owned["stages"])
+        for name in owned["modules"]:
+            sys.modules.pop(name, None)
+
+    def _attach(self, owned: dict):
+        commands.update(owned["commands"])
+        for (kind, funcs) in owned["hooks"].items():
+            self.client.hooks.setdefault(kind, []).extend(funcs)
+        self.client.dispatcher.attach(owned["dispatch"])
+        self.client.pipeline.attach(owned["stages"])
+        sys.modules.update(owned["modules"])
+
+    async def _wait_for_load(self, import_name: str):
+        fut = self._loads.get(import_name)
+        if fut is not None and not fut.done():
+            await asyncio.wait([fut])
+
+    async def unload(self, name: str):
+        """
+        Unloads a plugin, removing every command and hook it registered.
+
+        The plugin's `unload_plugin(client)` coroutine, if any, is ran first.
+        """
+        import_name = self.resolve(name)
+        async with self._lock:
+            await self._wait_for_load(import_name)
+            await self._teardown(self.client.modules.get(import_name))
+            self._detach(self.owned(import_name))
+            self.client.modules.pop(import_name, None)
+            self._loads.pop(import_name, None)
+            self.manifest.pop(import_name, None)
+        logger.info("Unloaded plugin {}".format(import_name))
+        await util.with_threading(self._write_manifest)
+
+    async def reload(self, name: str):
+        """
+        Reloads a plugin in place.
+
+        If the new version fails to import, the old one is put back as it was. If it imports, but its load_plugin
+        fails, the plugin is left unloaded.
+        """
+        import_name = self.resolve(name)
+        async with self._lock:
+            await self._wait_for_load(import_name)
+            old_mod = self.client.modules.get(import_name)
+            old = self.owned(import_name)
+
+            # Take the old version out first, so the new one registers into a clean slate.
+            self._detach(old)
+            importlib.invalidate_caches()
+            self.manifest[import_name] = {"mtime": self.discover().get(import_name, 0)}
+            try:
+                mod = self._import(import_name)
+            except Exception:
+                logger.exception("Error upon reloading plugin `{}`, keeping the old version.".format(import_name))
+                self._detach(self.owned(import_name))
+                self._attach(old)
+                if old_mod is not None:
+                    self.manifest[import_name] = self._describe(import_name, old_mod,
+                                                                self.manifest[import_name]["mtime"])
+                raise
+
+            await self._teardown(old_mod)
+            self.client.modules.pop(import_name, None)
+            fut = self._loads[import_name] = asyncio.ensure_future(self._setup(import_name, mod))
+            try:
+                await asyncio.shield(fut)
+            except Exception:
+                logger.exception("Error upon reloading plugin `{}`, it is now unloaded.".format(import_name))
+                self._detach(self.owned(import_name))
+                self._loads.pop(import_name, None)
+                self.manifest.pop(import_name, None)
+                raise
+            finally:
+                await util.with_threading(self._write_manifest)
+        logger.info("Reloaded plugin {}".format(import_name))
+
+    # endregion
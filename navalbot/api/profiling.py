@@ -0,0 +1,149 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# On-demand profiling of the running bot.
+# `sample` takes the loop thread's stack from a worker thread every few milliseconds, and writes collapsed stacks
+# (one `a;b;c count` line per stack) which flamegraph.pl and speedscope read. It costs the loop next to nothing.
+# `cprofile` runs cProfile on the loop thread, and writes a .pstats file. It is exact, but slows the loop down.
+# Neither stops messages being handled while they run.
+import asyncio
+import collections
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from navalbot import exceptions
+from navalbot.api import executors, util
+
+logger = logging.getLogger("NavalBot")
+
+MODES = ("sample", "cprofile")
+
+_running = False
+
+
+def _config() -> dict:
+    return util.get_global_config("profiling", default={}) or {}
+
+
+def _path(extension: str) -> str:
+    directory = _config().get("dir", "profiles")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, "{}-{}.{}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid(), extension))
+
+
+def _label(code) -> str:
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+# region sampling
+def _sample(thread_id: int, seconds: float, interval: float, path: str, top: int) -> str:
+    """
+    Samples a thread's stack until the time is up, then writes the collapsed stacks. Runs in a worker thread.
+    """
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            labels = []
+            while frame is not None:
+                labels.append(_label(frame.f_code))
+                frame = frame.f_back
+            stacks[";".join(reversed(labels))] += 1
+        del frame
+        time.sleep(interval)
+
+    with open(path, "w") as f:
+        for stack, count in stacks.items():
+            f.write("{} {}\n".format(stack, count))
+
+    # Self time is the innermost frame of each stack.
+    hottest = collections.Counter()
+    for stack, count in stacks.items():
+        hottest[stack.rsplit(";", 1)[-1]] += count
+    total = sum(stacks.values()) or 1
+    lines = ["{} samples. Time spent in each function itself:".format(total)]
+    for label, count in hottest.most_common(top):
+        lines.append("{:>6.1%} {:>6}  {}".format(count / total, count, label))
+    return "\n".join(lines)
+
+
+# endregion
+
+# region cProfile
+def _write_pstats(profiler: cProfile.Profile, path: str, top: int) -> str:
+    """
+    Writes out a finished cProfile session, and summarises it. Runs in a worker thread.
+    """
+    profiler.dump_stats(path)
+    stats = pstats.Stats(profiler).stats
+    hottest = sorted(stats.items(), key=lambda i: i[1][2], reverse=True)[:top]
+    lines = ["{:>9} {:>9} {:>8}  {}".format("own", "total", "calls", "function")]
+    for func, (cc, nc, tt, ct, callers) in hottest:
+        lines.append("{:>8.3f}s {:>8.3f}s {:>8}  {}".format(tt, ct, nc, pstats.func_std_string(func)))
+    return "\n".join(lines)
+
+
+# endregion
+
+
+async def profile(seconds: float, mode: str = "sample") -> tuple:
+    """
+    Profiles the event loop thread for a while.
+
+    Returns the path written to, and a summary of the hottest functions.
+    Raises a CommandError if a profile is already running.
+    """
+    global _running
+    if _running:
+        raise exceptions.CommandError(":x: A profile is already running.")
+    _running = True
+
+    cfg = _config()
+    top = int(cfg.get("top", 15))
+    try:
+        if mode == "sample":
+            path = _path("folded")
+            summary = await executors.threads.run(_sample, threading.get_ident(), seconds,
+                                                  float(cfg.get("sample_interval", 0.005)), path, top)
+        elif mode == "cprofile":
+            path = _path("pstats")
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+            summary = await executors.threads.run(_write_pstats, profiler, path, top)
+        else:
+            raise ValueError("Unknown profiling mode {}".format(mode))
+    finally:
+        _running = False
+
+    logger.info("Wrote a {}s {} profile to {}.".format(seconds, mode, path))
+    return path, summary
@@ -0,0 +1,190 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Command scheduling.
+# Commands need a slot before they run. Only so many run at once in total, per server, and per command (the
+# `concurrency` argument of @command). When slots are short, waiting servers are served round robin, so one busy
+# server can't starve the rest. The owner's commands skip the queue.
+import asyncio
+import collections
+import logging
+import time
+
+from navalbot import exceptions
+from navalbot.api import metrics, util
+
+logger = logging.getLogger("NavalBot")
+
+
+class _Waiter(object):
+    __slots__ = ("server_id", "command", "limit", "future")
+
+    def __init__(self, server_id: str, command: str, limit: int, future: asyncio.Future):
+        self.server_id = server_id
+        self.command = command
+        self.limit = limit
+        self.future = future
+
+
+class CommandScheduler(object):
+    """
+    Hands out command slots fairly between servers.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        cfg = util.get_global_config("scheduler", default={}) or {}
+        self.enabled = cfg.get("enabled", True)
+        self.max_running = int(cfg.get("max_running", 64))
+        self.per_server = int(cfg.get("per_server", 4))
+        self.max_queued = int(cfg.get("max_queued_per_server", 50))
+
+        self.loop = loop or asyncio.get_event_loop()
+
+        # server id -> waiters, in the order servers will be served.
+        self._waiting = collections.OrderedDict()
+        self.running = 0
+        self._running_servers = {}
+        self._running_commands = {}
+
+    def depth(self, server_id: str = None) -> int:
+        """
+        Commands waiting for a slot, for one server or in total.
+        """
+        if server_id is not None:
+            return len(self._waiting.get(server_id, ()))
+        return sum(len(q) for q in self._waiting.values())
+
+    def _has_room(self, server_id: str, command: str, limit: int) -> bool:
+        return (self.running < self.max_running and
+                self._running_servers.get(server_id, 0) < self.per_server and
+                (not limit or self._running_commands.get(command, 0) < limit))
+
+    def _take(self, server_id: str, command: str):
+        self.running += 1
+        self._running_servers[server_id] = self._running_servers.get(server_id, 0) + 1
+        self._running_commands[command] = self._running_commands.get(command, 0) + 1
+
+    async def acquire(self, server_id: str, command: str, limit: int = None, owner: bool = False):
+        """
+        Waits for a slot to run a command in. Pass what this returns to release() once the command is done.
+
+        Raises a CommandError if too many commands are already waiting for this server.
+        """
+        if owner:
+            # The priority lane. It isn't counted against any limit, so it always runs straight away.
+            metrics.SCHEDULER_WAIT.observe(0.0, "owner")
+            return None
+
+        ticket = (server_id, command)
+        if not self.enabled or (server_id not in self._waiting and self._has_room(server_id, command, limit)):
+            self._take(server_id, command)
+            metrics.SCHEDULER_WAIT.observe(0.0, "normal")
+            return ticket
+
+        queue = self._waiting.get(server_id)
+        if queue is None:
+            queue = self._waiting[server_id] = collections.deque()
+        if len(queue) >= self.max_queued:
+            metrics.SCHEDULER_REJECTED.inc()
+            raise exceptions.CommandError(":hourglass: Too many commands are waiting on this server. "
+                                          "Try again in a moment.")
+
+        waiter = _Waiter(server_id, command, limit, self.loop.create_future())
+        queue.append(waiter)
+        # It may be able to run already, if what's ahead of it is only held up by a command limit.
+        self._pump()
+        start = time.monotonic()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                self._remove(waiter)
+            else:
+                # The slot was handed over just as we were cancelled.
+                self.release(ticket)
+            raise
+        metrics.SCHEDULER_WAIT.observe(time.monotonic() - start, "normal")
+        return ticket
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._waiting.get(waiter.server_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._waiting[waiter.server_id]
+
+    def release(self, ticket):
+        """
+        Gives a slot back, and hands it to the next server in line.
+        """
+        if ticket is None:
+            return
+        server_id, command = ticket
+        self.running -= 1
+        for counts, key in ((self._running_servers, server_id), (self._running_commands, command)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        self._pump()
+
+    def _pump(self):
+        """
+        Hands out free slots, one server at a time.
+        """
+        while self.running < self.max_running and self._waiting:
+            granted = False
+            for server_id in list(self._waiting):
+                if self.running >= self.max_running:
+                    break
+                queue = self._waiting[server_id]
+                waiter = self._next_runnable(queue)
+                if not queue:
+                    del self._waiting[server_id]
+                elif waiter is not None:
+                    # Go to the back of the line.
+                    self._waiting.move_to_end(server_id)
+                if waiter is None:
+                    continue
+                self._take(server_id, waiter.command)
+                waiter.future.set_result(None)
+                granted = True
+            if not granted:
+                return
+
+    def _next_runnable(self, queue: collections.deque):
+        """
+        Takes the first waiter in a server's queue which can run now.
+        """
+        for waiter in list(queue):
+            if waiter.future.done():
+                # Cancelled.
+                queue.remove(waiter)
+                continue
+            if self._has_room(waiter.server_id, waiter.command, waiter.limit):
+                queue.remove(waiter)
+                return waiter
+        return None
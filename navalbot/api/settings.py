@@ -0,0 +1,56 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Configuration.
+# config.yml is parsed once per process, here, and the same dict is shared by everything that needs it.
+import os
+import shutil
+
+import yaml
+
+try:
+    # The C loader is much faster, when libyaml is available.
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+CONFIG_PATH = "config.yml"
+EXAMPLE_PATH = "config.example.yml"
+
+_config = None
+
+
+def load(path: str = CONFIG_PATH) -> dict:
+    """
+    Gets the config, parsing it the first time.
+
+    If there is no config.yml, the example config is copied there first.
+    """
+    global _config
+    if _config is None:
+        if not os.path.exists(path):
+            shutil.copyfile(EXAMPLE_PATH, path)
+        with open(path, "r") as f:
+            _config = yaml.load(f, Loader=Loader) or {}
+    return _config
+
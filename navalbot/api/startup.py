@@ -0,0 +1,75 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Startup timing.
+# This is imported before anything heavy, so it only uses the standard library.
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger("NavalBot")
+
+started = time.monotonic()
+
+# (name, seconds), in order.
+phases = []
+
+_reported = False
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """
+    Times one step of starting up.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phases.append((name, time.monotonic() - start))
+
+
+def mark(name: str):
+    """
+    Records the time since the last phase ended, as its own phase.
+    """
+    accounted = started + sum(seconds for (_, seconds) in phases)
+    phases.append((name, time.monotonic() - accounted))
+
+
+def report():
+    """
+    Logs how long startup took, and where the time went. This only does anything the first time.
+    """
+    global _reported
+    if _reported:
+        return
+    _reported = True
+
+    total = time.monotonic() - started
+    logger.info("Started up in {:.2f}s: {}".format(total, ", ".join(
+        "{} {:.2f}s".format(name, seconds) for (name, seconds) in phases)))
+
+    from navalbot.api import metrics
+    for (name, seconds) in phases:
+        metrics.STARTUP_SECONDS.set(seconds, name)
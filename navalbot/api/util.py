@@ -24,17 +24,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 import asyncio
 import datetime
 import os
-import shutil
 import time
-from concurrent import futures
 from math import floor
 
-import aiohttp
 import aioredis
 import discord
-import yaml
 
-from navalbot.api import db
+from navalbot.api import db, executors, permissions, settings
 
 startup = datetime.datetime.fromtimestamp(time.time())
 
@@ -43,23 +39,30 @@ msgcount = 0
 
 loop = asyncio.get_event_loop()
 
-threaded = futures.ThreadPoolExecutor()
+# The thread pool, for code which needs an Executor. Use with_threading instead.
+# It doesn't start the pool on import, and still works after the pool is shut down.
+threaded = executors.LazyExecutor(executors.threads)
 
 # Declare redis pool
 redis_pool = None
 
 # Load config.
-if not os.path.exists("config.yml"):
-    shutil.copyfile("config.example.yml", "config.yml")
+global_config = settings.load()
 
-with open("config.yml", "r") as f:
-    global_config = yaml.load(f)
-
-async def with_threading(func):
+async def with_threading(func, *args):
     """
     Runs a func inside a Threaded executor.
     """
-    return await loop.run_in_executor(threaded, func)
+    return await executors.threads.run(func, *args)
+
+
+async def with_process(func, *args):
+    """
+    Runs a func inside a process pool, for CPU heavy work which would otherwise hold the GIL.
+
+    The func and its arguments must be picklable, so it has to be a module level function, not a lambda or closure.
+    """
+    return await executors.processes.run(func, *args)
 
 
 def format_timedelta(value, time_format="{days} days, {hours2}:{minutes2}:{seconds2}"):
@@ -117,6 +120,19 @@ async def get_pool() -> aioredis.RedisPool:
     return redis_pool
 
 
+async def create_redis() -> aioredis.Redis:
+    """
+    Creates a dedicated redis connection.
+
+    This is for things which cannot share the pool, such as pub/sub subscriptions.
+    """
+    return await aioredis.create_redis(
+        (global_config["redis"]["ip"], global_config["redis"]["port"]),
+        db=int(global_config["redis"].get("db", 0)),
+        password=global_config["redis"].get("password")
+    )
+
+
 def has_permissions(author: discord.Member, roles: set):
     U_roles = set([r.name for r in author.roles])
     if roles.intersection(U_roles):
@@ -127,22 +143,10 @@ def has_permissions(author: discord.Member, roles: set):
 
 async def has_permissions_with_override(author: discord.Member, roles: set,
                                         serv_id: int, cmd_name: str):
-    allowed = await _get_overrides(serv_id, cmd_name)
-
-    allowed = roles.union(allowed)
-
-    return has_permissions(author, allowed)
+    return await permissions.get_resolver().has_permissions(author, roles, serv_id, cmd_name)
 
 async def _get_overrides(serv_id: int, cmd_name: str) -> set:
-    async with (await get_pool()).get() as conn:
-        assert isinstance(conn, aioredis.Redis)
-        override = await conn.smembers("override:{}:{}".format(serv_id, cmd_name))
-        if override:
-            override = {_.decode() for _ in override}
-        else:
-            override = set()
-
-    return override
+    return set(await permissions.get_resolver().get_overrides(serv_id, cmd_name))
 
 
 async def get_prefix(id: str) -> str:
@@ -161,6 +165,9 @@ def prov_dec_func(func1, func2):
 
     func2.__doc__ = func1.__doc__
     func2.__name__ = func1.__name__
+    # So the wrapper is attributed to the plugin which defined the command, not to decorators.
+    func2.__module__ = func1.__module__
+    func2.__qualname__ = getattr(func1, "__qualname__", func1.__name__)
 
     if hasattr(func1, "__methods"):
         func2.__methods = func1.__methods
@@ -187,6 +194,7 @@ async def get_file(client: tuple, url, name):
     """
     Get a file from the web using aiohttp, and save it
     """
+    import aiohttp
     with aiohttp.ClientSession() as sess:
         async with sess.get(url) as get:
             assert isinstance(get, aiohttp.ClientResponse)
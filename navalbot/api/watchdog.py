@@ -0,0 +1,202 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Event loop watchdog.
+# The loop ticks a heartbeat. A thread checks it, and when the loop has been stuck for longer than the threshold,
+# it grabs the loop thread's stack, and works out which command, hook or plugin it is stuck in.
+# Stalls are kept in a rolling report, which the `stalls` command shows.
+import collections
+import inspect
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import discord
+
+from navalbot.api import metrics, util
+from navalbot.api.commands import commands, Command
+
+logger = logging.getLogger("NavalBot")
+
+# Frames kept per stall.
+STACK_LIMIT = 15
+
+
+class Stall(object):
+    """
+    One stretch of time the loop was blocked for.
+    """
+
+    def __init__(self, started: float, owner: str, stack: list):
+        self.started = started
+        self.owner = owner
+        self.stack = stack
+        self.duration = None
+        self.time = time.time()
+
+
+class LoopWatchdog(object):
+    """
+    Watches the loop from a thread, and reports what blocked it.
+    """
+
+    def __init__(self, client: discord.Client):
+        cfg = util.get_global_config("watchdog", default={}) or {}
+        self.enabled = cfg.get("enabled", True)
+        self.threshold = float(cfg.get("threshold", 0.25))
+        self.interval = float(cfg.get("interval", 0.05))
+
+        self.client = client
+        self.loop = client.loop
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._loop_thread = None
+        self._last_beat = time.monotonic()
+        # The stall being captured right now, until the loop wakes up again.
+        self._current = None
+
+        self.stalls = collections.deque(maxlen=int(cfg.get("keep", 50)))
+        # owner -> [stalls, total seconds]
+        self.totals = {}
+
+    def start(self):
+        """
+        Starts the heartbeat and the watchdog thread. This must be called from the loop, and is safe to call twice.
+        """
+        if not self.enabled or self._thread is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self.loop.call_later(self.interval, self._beat)
+        self._thread = threading.Thread(target=self._watch, name="NavalBot loop watchdog", daemon=True)
+        self._thread.start()
+        logger.info("Watching the loop for stalls over {:.2f}s.".format(self.threshold))
+
+    def _beat(self):
+        now = time.monotonic()
+        with self._lock:
+            stall, self._current = self._current, None
+            previous, self._last_beat = self._last_beat, now
+        if stall is not None:
+            stall.duration = now - previous - self.interval
+            self._record(stall)
+        self.loop.call_later(self.interval, self._beat)
+
+    def _record(self, stall: Stall):
+        self.stalls.append(stall)
+        total = self.totals.setdefault(stall.owner, [0, 0.0])
+        total[0] += 1
+        total[1] += stall.duration
+        metrics.LOOP_STALLS.inc(stall.owner)
+        logger.warning("The loop was blocked for {:.2f}s by {}, at:\n{}".format(
+            stall.duration, stall.owner, "".join(stall.stack[-3:]).rstrip()))
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if self._current is not None or time.monotonic() - self._last_beat < self.threshold + self.interval:
+                    continue
+                started = self._last_beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            try:
+                stall = Stall(started, self._attribute(frame), traceback.format_stack(frame, limit=STACK_LIMIT))
+            finally:
+                del frame
+            with self._lock:
+                # Only keep it if the loop is still stuck in the same stall.
+                if self._last_beat == started:
+                    self._current = stall
+
+    # region attribution
+    @staticmethod
+    def _unwrap(func):
+        # util.prov_dec_func wrappers point at the original function with .func, not __wrapped__.
+        return inspect.unwrap(getattr(func, "func", func))
+
+    def _owners(self) -> dict:
+        """
+        Maps the code of every command and hook to who owns it.
+        """
+        owners = {}
+        for name, cmd in list(commands.items()):
+            func = cmd._wrapped_coro if isinstance(cmd, Command) else cmd
+            if func is None:
+                continue
+            func = self._unwrap(func)
+            if hasattr(func, "__code__"):
+                owners.setdefault(func.__code__, "command {}".format(name))
+        for hook in list(self.client.dispatcher.hooks):
+            func = self._unwrap(hook.func)
+            if hasattr(func, "__code__"):
+                owners[func.__code__] = "hook {}".format(hook.name)
+        return owners
+
+    def _attribute(self, frame) -> str:
+        """
+        Works out who owns a stack, from the innermost frame out.
+        """
+        try:
+            owners = self._owners()
+        except RuntimeError:
+            # Changed while we were reading it.
+            owners = {}
+        module = None
+        while frame is not None:
+            owner = owners.get(frame.f_code)
+            if owner is not None:
+                return owner
+            name = frame.f_globals.get("__name__", "")
+            if module is None and (name.startswith("plugins.") or name == "navalbot.builtins"):
+                module = name
+            frame = frame.f_back
+        if module is not None:
+            return "module {}".format(module)
+        return "unknown"
+
+    # endregion
+
+    def report(self, count: int = 5) -> str:
+        """
+        Summarises the worst owners, and the latest stalls.
+        """
+        if not self.stalls:
+            return "No stalls over {:.2f}s seen.".format(self.threshold)
+        lines = ["Worst offenders:"]
+        worst = sorted(self.totals.items(), key=lambda i: i[1][1], reverse=True)[:count]
+        for owner, (stalls, total) in worst:
+            lines.append("  {:<40} {:>4} stalls  {:>8.2f}s".format(owner, stalls, total))
+        lines.append("")
+        lines.append("Latest:")
+        for stall in list(self.stalls)[-count:]:
+            lines.append("  {} {:>6.2f}s  {}".format(time.strftime("%H:%M:%S", time.localtime(stall.time)),
+                                                      stall.duration, stall.owner))
+        lines.append("")
+        lines.append("Last stack:")
+        lines.append("".join(self.stalls[-1].stack[-5:]).rstrip())
+        return "\n".join(lines)
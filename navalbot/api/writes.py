@@ -0,0 +1,208 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Write-behind buffer for config writes.
+# Writes are queued, repeated writes to one key are coalesced, and everything is flushed in one MULTI/EXEC after a
+# short interval, or straight away once enough writes are waiting.
+# Until a write has been flushed, reads of that key are answered from the buffer.
+import asyncio
+import logging
+from collections import OrderedDict
+
+from navalbot.api import metrics, util
+from navalbot.api.cache import MISSING
+
+logger = logging.getLogger("NavalBot")
+
+# Marks a queued delete.
+DELETED = object()
+
+_buffer = None
+
+
+class WriteBuffer(object):
+    """
+    Queues config writes, and flushes them in batches.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        cfg = util.get_global_config("writes", default={}) or {}
+        self.interval = float(cfg.get("interval", 0.05))
+        self.max_pending = int(cfg.get("max_pending", 500))
+        self.max_retry_delay = float(cfg.get("max_retry_delay", 30))
+
+        self.loop = loop or asyncio.get_event_loop()
+        # (server_id, key) -> value or DELETED, waiting to be flushed.
+        self._pending = OrderedDict()
+        # The batch being flushed right now. It is still read from until it has been written.
+        self._flushing = {}
+
+        self._handle = None
+        self._task = None
+        self._retry_delay = self.interval
+        # The error from the last flush, if it failed.
+        self.last_error = None
+
+        metrics.CONFIG_WRITES_PENDING.set_function(lambda: len(self))
+
+    def __len__(self):
+        return len(self._pending) + len(self._flushing)
+
+    def get(self, server_id: str, key: str):
+        """
+        Gets a write which hasn't been flushed yet.
+
+        Returns MISSING if there is none, and None for a queued delete.
+        """
+        op = (server_id, key)
+        value = self._pending.get(op, MISSING)
+        if value is MISSING:
+            value = self._flushing.get(op, MISSING)
+        return None if value is DELETED else value
+
+    def pending_for(self, server_id: str) -> dict:
+        """
+        Gets every unflushed write for a server, as key -> value, with None for deletes.
+        """
+        values = {}
+        for source in (self._flushing, self._pending):
+            for (sid, key), value in source.items():
+                if sid == server_id:
+                    values[key] = None if value is DELETED else value
+        return values
+
+    # region queueing
+    def set(self, server_id: str, key: str, value: str):
+        self._queue((server_id, key), value)
+
+    def delete(self, server_id: str, key: str):
+        self._queue((server_id, key), DELETED)
+
+    def _queue(self, op: tuple, value):
+        if op in self._pending:
+            metrics.CONFIG_WRITES_COALESCED.inc()
+            # Keep the order of the latest write.
+            del self._pending[op]
+        self._pending[op] = value
+
+        if len(self._pending) >= self.max_pending:
+            self._schedule(0)
+        else:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay: float):
+        if self._task is not None:
+            # The running flush picks up anything queued meanwhile.
+            return
+        if self._handle is not None:
+            if delay > 0:
+                return
+            self._handle.cancel()
+        self._handle = self.loop.call_later(delay, self._start)
+
+    def _start(self):
+        self._handle = None
+        if self._task is None and self._pending:
+            self._task = self.loop.create_task(self._run())
+
+    # endregion
+
+    async def _run(self):
+        try:
+            while self._pending:
+                try:
+                    await self._flush_once()
+                except Exception as e:
+                    self.last_error = e
+                    metrics.CONFIG_WRITE_ERRORS.inc()
+                    logger.exception("Failed to flush {} config writes, retrying in {:.1f}s."
+                                     .format(len(self._flushing), self._retry_delay))
+                    # Put them back, unless they have been written again since.
+                    for op, value in self._flushing.items():
+                        if op not in self._pending:
+                            self._pending[op] = value
+                    self._flushing = {}
+                    await asyncio.sleep(self._retry_delay)
+                    self._retry_delay = min(self._retry_delay * 2, self.max_retry_delay)
+                else:
+                    self.last_error = None
+                    self._retry_delay = self.interval
+        finally:
+            self._task = None
+
+    async def _flush_once(self):
+        # db imports this module, so this is imported here.
+        from navalbot.api import db
+        self._flushing, self._pending = self._pending, OrderedDict()
+        hash_mode = db._hash_mode()
+        migrated = await db._is_migrated() if hash_mode else True
+
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            tr = conn.multi_exec()
+            for (server_id, key), value in self._flushing.items():
+                if hash_mode:
+                    if value is DELETED:
+                        tr.hdel(db._hash_key(server_id), key)
+                    else:
+                        tr.hset(db._hash_key(server_id), key, value)
+                    if not migrated:
+                        # Don't let a stale old key shadow the new value.
+                        tr.delete(db._legacy_key(server_id, key))
+                elif value is DELETED:
+                    tr.delete(db._legacy_key(server_id, key))
+                else:
+                    tr.set(db._legacy_key(server_id, key), value)
+                tr.publish(db.INVALIDATION_CHANNEL, db._build_invalidation(server_id, key))
+            with metrics.redis_call("flush_writes"):
+                await tr.execute()
+
+        metrics.CONFIG_WRITES_FLUSHED.inc(amount=len(self._flushing))
+        self._flushing = {}
+
+    async def flush(self):
+        """
+        Writes everything queued so far.
+
+        Raises the error if the flush fails. The writes stay queued, and will be retried.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        while self._pending or self._flushing:
+            if self._task is None:
+                self._task = self.loop.create_task(self._run())
+            error = self.last_error
+            await asyncio.wait([self._task], timeout=self._retry_delay + 1)
+            if self.last_error is not None and self.last_error is not error:
+                raise self.last_error
+
+
+def get_buffer() -> WriteBuffer:
+    """
+    Gets the shared write buffer.
+    """
+    global _buffer
+    if _buffer is None:
+        _buffer = WriteBuffer()
+    return _buffer
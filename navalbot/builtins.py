@@ -22,14 +22,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 =================================
 """
-import os
 
 import discord
 import re
 
-from navalbot.api.commands import commands, command, Command
-from navalbot.api import decorators, db
-from navalbot.api.util import sanitize, get_file
+from navalbot.api.commands import commands, command, Command, converters
+from navalbot.api import attachments, decorators, db, factoids, filestore, outbound, profiling
+from navalbot.exceptions import CommandError
 
 
 # Factoid matcher compiled
@@ -47,29 +46,90 @@ async def help(client: discord.Client, message: discord.Message, cmd_name: str):
     # Get the function
     func = commands.get(cmd_name)
     if not func:
-        await client.send_message(message.channel, ":no_entry: That function does not exist!")
+        await client.send_message(message.channel, ":no_entry: That function does not exist!", priority=outbound.ERROR)
         return
 
     if hasattr(func, "help"):
         help = func.help()
         if not help:
-            await client.send_message(message.channel, ":x: This function doesn't have help.")
+            await client.send_message(message.channel, ":x: This function doesn't have help.", priority=outbound.ERROR)
             return
     else:
         # Format __doc__
         if not func.__doc__:
-            await client.send_message(message.channel, ":x: This function doesn't have help.")
+            await client.send_message(message.channel, ":x: This function doesn't have help.", priority=outbound.ERROR)
             return
         help = func.__doc__
 
     doc = help.split("\n")
     doc = [d.lstrip() for d in doc if d.lstrip()]
     doc = '\n'.join(doc)
-    await client.send_message(message.channel, doc)
+    await client.send_message(message.channel, doc, priority=outbound.RESULT)
+
+
+# region plugins
+@command("reload", owner=True, argcount=1, argerror=":x: You must provide a plugin to reload.")
+async def reload(client: discord.Client, message: discord.Message, name: str):
+    """
+    Reloads a plugin in place, without reconnecting.
+    """
+    try:
+        await client.plugins.reload(name)
+    except KeyError:
+        return ":x: No such plugin `{}`.".format(name)
+    except Exception as e:
+        return ":x: Could not reload `{}`: `{}`".format(name, e)
+    return ":heavy_check_mark: Reloaded `{}`.".format(name)
+
+
+@command("unload", owner=True, argcount=1, argerror=":x: You must provide a plugin to unload.")
+async def unload(client: discord.Client, message: discord.Message, name: str):
+    """
+    Unloads a plugin, and every command and hook it provides.
+    """
+    try:
+        await client.plugins.unload(name)
+    except KeyError:
+        return ":x: No such plugin `{}`.".format(name)
+    return ":heavy_check_mark: Unloaded `{}`.".format(name)
+
+
+# endregion
+
+# region diagnostics
+@command("stalls", owner=True)
+async def stalls(client: discord.Client, message: discord.Message):
+    """
+    Shows what has been blocking the event loop.
+    """
+    report = client.watchdog.report()
+    # Keep the end of the report, which has the latest stack, if it is too long.
+    return "```\n{}\n```".format(report[-(outbound.MAX_LENGTH - 10):])
+
+
+@command("profile", owner=True, argcount=2,
+         argerror=":x: Usage: `profile <seconds> <sample|cprofile>`. `sample` is cheap, `cprofile` is exact.")
+async def profile(client: discord.Client, message: discord.Message, seconds: converters.Integer(1, 300),
+                  mode: converters.Choice(*profiling.MODES)):
+    """
+    Profiles the bot for a while, and shows the hottest functions.
+    """
+    await client.send_message(message.channel, ":stopwatch: Profiling for {}s...".format(seconds))
+    try:
+        path, summary = await profiling.profile(seconds, mode)
+    except CommandError as e:
+        return e.message
+    header = ":heavy_check_mark: Wrote `{}`.\n".format(path)
+    return header + "```\n{}\n```".format(summary[:outbound.MAX_LENGTH - len(header) - 10])
+
+
+# endregion
 
 # region factoids
-async def default(client: discord.Client, message: discord.Message):
-    prefix = await db.get_config(message.server.id, "command_prefix", "?")
+async def default(client: discord.Client, message: discord.Message, config: db.ServerConfig = None):
+    if config is None:
+        config = await db.get_server_config(message.server.id, ("command_prefix",))
+    prefix = config.get("command_prefix", "?")
     data = message.content[len(prefix):]
     # Check if it matches a factoid creation
     matches = factoid_matcher.match(data)
@@ -82,17 +142,31 @@ async def default(client: discord.Client, message: discord.Message):
         # Check if it's locked.
         locked = await db.get_config(message.server.id, "fac:{}:locked".format(name), default=None)
         if locked and locked != message.author.id:
-            await client.send_message(message.channel, ":x: Cannot edit, factoid is locked to ID `{}`.".format(locked))
+            await client.send_message(message.channel, ":x: Cannot edit, factoid is locked to ID `{}`.".format(locked),
+                                      priority=outbound.ERROR)
             return
         assert isinstance(fac, str)
+        store = filestore.get_store()
         if fac.startswith("http") and 'youtube' not in fac:
             # download as a file
-            file = sanitize(fac.split('/')[-1])
-            client.loop.create_task(get_file((client, message), url=fac, name=file))
-            fac = "file:{}".format(file)
+            try:
+                ref = await store.store_url(fac)
+            except CommandError as e:
+                await client.send_message(message.channel, e.message, priority=outbound.ERROR)
+                return
+            store.incref(ref)
+            fac = "file:{}".format(ref)
+        # Release the file the factoid used to point to, if any.
+        old = await config.fetch("fac:{}".format(name))
+        if old and old.startswith("file:"):
+            store.decref(old[len("file:"):])
         await db.set_config(message.server.id, "fac:{}".format(name), fac)
-        await client.send_message(message.channel, ":heavy_check_mark: Factoid `{}` is now `{}`".format(name, fac))
+        await client.send_message(message.channel, ":heavy_check_mark: Factoid `{}` is now `{}`".format(name, fac),
+                                  priority=outbound.RESULT)
     else:
+        # Most misses never reach redis.
+        if not factoids.get_filter().might_exist(message.server.id, data):
+            return
         # Load content
         content = await db.get_config(message.server.id, "fac:{}".format(data))
         if not content:
@@ -103,28 +177,29 @@ async def default(client: discord.Client, message: discord.Message):
             # Run the inline command.
             sp = inline_cmd.groups()[0]
             first_word = sp.split(" ")[0]
-            prefix = await db.get_config(message.server.id, "command_prefix", "?")
             if first_word.startswith(prefix):
                 first_word = first_word[len(prefix):]
             # load it from commands
             print(first_word, commands)
             if first_word not in commands:
-                await client.send_message(message.channel, ":x: Inline command `{}` does not exist".format(first_word))
+                await client.send_message(message.channel, ":x: Inline command `{}` does not exist".format(first_word),
+                                          priority=outbound.ERROR)
                 return
             # Get it, and invoke.
             message.content = sp
             command = commands[first_word]
-            await command.invoke(client, message)
+            await command.invoke(client, message, config=config)
             return
 
         # Check if it's a file
         if content.startswith("file:"):
             fname = content.split("file:")[1]
-            if not os.path.exists(os.path.join(os.getcwd(), 'files', fname)):
-                await client.send_message(message.channel, ":x: Unknown error: File {} does not exist".format(fname))
-                return
-            # Load the file
-            with open(os.path.join(os.getcwd(), 'files', fname), 'rb') as f:
-                await client.send_file(message.channel, f)
+            path = filestore.get_store().path_for(fname)
+            # Stored objects never change, so they can be sent straight from memory.
+            sent = path is not None and await attachments.get_server().send(
+                client, message.channel, path, immutable=filestore.FileStore.is_ref(fname))
+            if not sent:
+                await client.send_message(message.channel, ":x: Unknown error: File {} does not exist".format(fname),
+                                          priority=outbound.ERROR)
             return
-        await client.send_message(message.channel, content)
\ No newline at end of file
+        await client.send_message(message.channel, content, priority=outbound.RESULT)
@@ -0,0 +1,114 @@
+"""
+Moves server configs from the old `config:{sid}:{key}` layout into one hash per server.
+
+This runs online, while the bot is up:
+
+ 1. Set `storage: hash` under `redis` in config.yml and restart every shard.
+    New writes now go into hashes, and reads fall back to the old keys.
+ 2. Run `python -m navalbot.migrate`.
+
+Each key is moved atomically, and never overwrites a value the bot has written to the hash in the meantime.
+Once no old keys remain, the bot is told to stop checking them.
+
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+import argparse
+import logging
+import sys
+
+from navalbot.api import db, util
+
+logger = logging.getLogger("NavalBot")
+
+# Moves one old key into its server hash.
+# KEYS[1] is the old key, KEYS[2] the hash, ARGV[1] the field.
+MOVE_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'string' then
+    return 0
+end
+local value = redis.call('GET', KEYS[1])
+redis.call('HSETNX', KEYS[2], ARGV[1], value)
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+
+async def migrate(count: int = 500, dry_run: bool = False) -> int:
+    """
+    Migrates every old config key. Returns the number of keys moved.
+    """
+    pool = await util.get_pool()
+    moved = 0
+    async with pool.get() as conn:
+        while True:
+            found = 0
+            moved_this_pass = 0
+            cursor = 0
+            while True:
+                cursor, keys = await conn.scan(cursor, match="config:*:*", count=count)
+                for key in keys:
+                    # config:sid:key, where key may contain colons itself.
+                    _, server_id, field = key.decode().split(":", 2)
+                    found += 1
+                    if dry_run:
+                        continue
+                    moved_this_pass += await conn.eval(MOVE_SCRIPT, keys=[key, db._hash_key(server_id)],
+                                                       args=[field])
+                if cursor == 0:
+                    break
+
+            if dry_run:
+                logger.info("{} keys would be migrated.".format(found))
+                return found
+            # Keep going until a full scan moves nothing, in case anything was written in the old layout meanwhile.
+            # Keys the script skips because they are not strings are found on every scan, so only moves count.
+            if not moved_this_pass:
+                break
+            moved += moved_this_pass
+            logger.info("Migrated {} keys so far.".format(moved))
+
+        await conn.set(db.MIGRATED_KEY, "1")
+        await conn.publish(db.INVALIDATION_CHANNEL, db._build_invalidation("*"))
+
+    logger.info("Migration finished, {} keys moved.".format(moved))
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrates server configs to per-server hashes.")
+    parser.add_argument("--count", type=int, default=500, help="Keys to request per SCAN.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the keys that would be moved.")
+    parser.add_argument("--force", action="store_true", help="Run even if config.yml is not set to hash storage.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - [%(levelname)s] %(name)s -> %(message)s')
+
+    if not db._hash_mode() and not (args.force or args.dry_run):
+        logger.error("config.yml does not have `storage: hash` set. Running shards would stop seeing migrated "
+                     "settings. Set it and restart them first, or pass --force.")
+        sys.exit(1)
+
+    util.loop.run_until_complete(migrate(args.count, args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+Runs every shard of the bot, one process per shard.
+
+Usage: python -m navalbot.supervisor [--shards auto|N]
+
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from navalbot.api import settings
+
+logger = logging.getLogger("NavalBot.supervisor")
+
+GATEWAY_URL = "https://discordapp.com/api/gateway/bot"
+
+# Discord only allows one IDENTIFY every 5 seconds.
+IDENTIFY_DELAY = 5.0
+
+
+def recommended_shards(token: str) -> int:
+    """
+    Asks Discord how many shards this bot should use.
+    """
+    import requests
+    r = requests.get(GATEWAY_URL, headers={"Authorization": "Bot {}".format(token)}, timeout=10)
+    r.raise_for_status()
+    return int(r.json()["shards"])
+
+
+# region heartbeats
+def _write_heartbeat(path: str, data: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+async def _heartbeat(client, path: str, shard_id: int, interval: float):
+    # Imported here, so the supervisor itself never loads the bot.
+    from navalbot.api import util
+
+    lag = 0.0
+    while True:
+        data = {
+            "pid": os.getpid(),
+            "shard_id": shard_id,
+            "time": time.time(),
+            "ready": client.is_logged_in and client.user is not None,
+            "servers": len(client.servers),
+            "messages": util.msgcount,
+            "loop_lag": lag,
+        }
+        try:
+            await util.with_threading(lambda: _write_heartbeat(path, data))
+        except OSError:
+            logger.exception("Could not write heartbeat.")
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - start - interval)
+
+
+def start_heartbeat(client, path: str, shard_id: int, interval: float = None):
+    """
+    Starts reporting this shard's health to the supervisor, through a file.
+    """
+    if interval is None:
+        interval = float((client.config.get("supervisor", {}) or {}).get("heartbeat_interval", 5))
+    client.loop.create_task(_heartbeat(client, path, shard_id, interval))
+
+
+# endregion
+
+
+class Shard(object):
+    """
+    One shard process.
+    """
+
+    def __init__(self, shard_id: int, count: int, run_dir: str, cpu: int = None):
+        self.shard_id = shard_id
+        self.count = count
+        self.cpu = cpu
+        self.heartbeat_path = os.path.join(run_dir, "shard-{}.json".format(shard_id))
+
+        self.process = None
+        self.started_at = None
+        self.next_start = 0.0
+        self.restarts = 0
+        # Consecutive quick crashes, for the backoff.
+        self.failures = 0
+        self.killed_at = None
+
+    def start(self):
+        try:
+            os.remove(self.heartbeat_path)
+        except FileNotFoundError:
+            pass
+        env = dict(os.environ, NAVALBOT_HEARTBEAT=self.heartbeat_path)
+        self.process = subprocess.Popen([sys.executable, "main.py", "--shard-id", str(self.shard_id),
+                                         "--shard-count", str(self.count)], env=env)
+        self.started_at = time.monotonic()
+        self.killed_at = None
+        if self.cpu is not None:
+            try:
+                os.sched_setaffinity(self.process.pid, {self.cpu})
+            except OSError:
+                pass
+        logger.info("Started shard {} (pid {}{}).".format(
+            self.shard_id, self.process.pid, ", cpu {}".format(self.cpu) if self.cpu is not None else ""))
+
+    def heartbeat(self) -> dict:
+        try:
+            with open(self.heartbeat_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def status(self) -> dict:
+        beat = self.heartbeat() or {}
+        running = self.process is not None and self.process.poll() is None
+        return {
+            "shard_id": self.shard_id,
+            "pid": self.process.pid if running else None,
+            "running": running,
+            "restarts": self.restarts,
+            "uptime": time.monotonic() - self.started_at if running else 0,
+            "ready": beat.get("ready", False),
+            "servers": beat.get("servers"),
+            "messages": beat.get("messages"),
+            "loop_lag": beat.get("loop_lag"),
+            "last_heartbeat": time.time() - beat["time"] if "time" in beat else None,
+        }
+
+
+class Supervisor(object):
+    """
+    Keeps every shard running.
+    """
+
+    def __init__(self, count: int, cfg: dict):
+        self.count = count
+        self.heartbeat_timeout = float(cfg.get("heartbeat_timeout", 60))
+        self.startup_grace = float(cfg.get("startup_grace", 120))
+        self.min_backoff = float(cfg.get("min_backoff", 1))
+        self.max_backoff = float(cfg.get("max_backoff", 300))
+        # A shard which ran this long before crashing is restarted straight away.
+        self.stable_after = float(cfg.get("stable_after", 60))
+        self.report_interval = float(cfg.get("report_interval", 60))
+
+        self.run_dir = os.path.join(os.getcwd(), cfg.get("run_dir", "run"))
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.status_path = os.path.join(self.run_dir, "supervisor.json")
+
+        cpus = None
+        if cfg.get("pin_cpus", True) and hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        self.shards = [Shard(i, count, self.run_dir, cpus[i % len(cpus)] if cpus else None) for i in range(count)]
+
+        self.running = True
+        self._last_identify = 0.0
+        self._last_report = time.monotonic()
+
+    def _backoff(self, shard: Shard) -> float:
+        return min(self.max_backoff, self.min_backoff * 2 ** max(0, shard.failures - 1))
+
+    def check(self, shard: Shard):
+        now = time.monotonic()
+        if shard.process is None:
+            # Waiting to be started. Space out starts, so shards don't identify at once.
+            if now >= shard.next_start and now - self._last_identify >= IDENTIFY_DELAY:
+                shard.start()
+                self._last_identify = now
+            return
+
+        code = shard.process.poll()
+        if code is not None:
+            ran = now - shard.started_at
+            shard.failures = 0 if ran >= self.stable_after else shard.failures + 1
+            delay = 0 if shard.failures == 0 else self._backoff(shard)
+            logger.error("Shard {} exited with code {} after {:.0f}s, restarting in {:.0f}s."
+                         .format(shard.shard_id, code, ran, delay))
+            shard.process = None
+            shard.restarts += 1
+            shard.next_start = now + delay
+            return
+
+        if shard.killed_at is not None:
+            # Hung shards get a chance to exit cleanly, then are killed.
+            if now - shard.killed_at > 10:
+                shard.process.kill()
+            return
+
+        beat = shard.heartbeat()
+        if beat is None:
+            stale = now - shard.started_at > self.startup_grace
+        else:
+            stale = time.time() - beat["time"] > self.heartbeat_timeout
+        if stale:
+            logger.error("Shard {} has stopped sending heartbeats, restarting it.".format(shard.shard_id))
+            shard.process.terminate()
+            shard.killed_at = now
+
+    def report(self):
+        statuses = [shard.status() for shard in self.shards]
+        for s in statuses:
+            logger.info("Shard {shard_id}: {state}, {servers} servers, {messages} messages, loop lag {lag}, "
+                        "{restarts} restarts".format(
+                            state="ready" if s["ready"] else ("running" if s["running"] else "down"),
+                            lag="{:.3f}s".format(s["loop_lag"]) if s["loop_lag"] is not None else "?",
+                            **s))
+        with open(self.status_path + ".tmp", "w") as f:
+            json.dump({"time": time.time(), "shards": statuses}, f, indent=2)
+        os.replace(self.status_path + ".tmp", self.status_path)
+
+    def stop(self, *args):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        logger.info("Supervising {} shards.".format(self.count))
+
+        while self.running:
+            for shard in self.shards:
+                self.check(shard)
+            if time.monotonic() - self._last_report >= self.report_interval:
+                self._last_report = time.monotonic()
+                self.report()
+            time.sleep(0.5)
+
+        logger.info("Stopping every shard.")
+        running = [s.process for s in self.shards if s.process is not None and s.process.poll() is None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs every shard of NavalBot, one process each.")
+    parser.add_argument("--shards", help="The total number of shards, or `auto` to ask Discord. Overrides "
+                                         "config.yml.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s - %(message)s")
+
+    config = settings.load()
+    cfg = config.get("supervisor", {}) or {}
+
+    shards = args.shards or str(cfg.get("shards", "auto"))
+    if shards == "auto":
+        token = config.get("client", {}).get("oauth_bot_token")
+        if not token:
+            logger.critical("Asking Discord for a shard count needs an OAuth bot token.")
+            sys.exit(1)
+        count = recommended_shards(token)
+        logger.info("Discord recommends {} shards.".format(count))
+    else:
+        count = int(shards)
+    if count < 1:
+        logger.critical("Need at least one shard.")
+        sys.exit(1)
+
+    Supervisor(count, cfg).run()
+
+
+if __name__ == '__main__':
+    main()